@@ -1,110 +1,449 @@
 import asyncio
-import tempfile
+import hashlib
+import os
+import time
+from collections import deque
 from pathlib import Path
+
+import aiofiles
 import structlog
 from telethon import TelegramClient
-from aio_pika import connect_robust, ExchangeType, Message
+from telethon.errors import FloodWaitError
+
+from shared.cache import MISSING, SeenIndex, TTLCache
 from shared.config import settings
-from shared.models import TelegramDocument, DownloadedFile
-from shared.utils import compute_sha256, get_storage_path, is_extractable
+from shared.messaging import BatchPublisher, connect, consume_lanes, lane_key
+from shared.models import DownloadedFile, TelegramDocument
+from shared.ratelimit import TokenBucket
+from shared.sniff import Sniffed, sniff_file
+from shared.storage import get_blob_store
+from shared.utils import get_staging_path
+from shared.wire import decode
 
 log = structlog.get_logger(service="downloader")
 
+CHAT_BURST = 3       # requisições em rajada por chat
+GLOBAL_BURST = 10    # requisições em rajada na conta
+FLOOD_RETRIES = 3    # novas tentativas após FLOOD_WAIT
+MAX_IDS_PER_CALL = 100  # limite do Telegram para messages.getMessages
+MESSAGE_CACHE_SIZE = 10_000
+PART_CHUNK = 512 * 1024  # requisição máxima do upload.getFile (offsets alinhados a ela)
+HASH_READ_BYTES = 4 * 1024 * 1024
 
-class Downloader:
-    def __init__(self):
+
+class ByteBudget:
+    """Limita a soma de bytes em download simultâneo (disco/banda); um arquivo maior
+    que o limite só começa quando nada mais está baixando.
+
+    A admissão é em ordem de chegada: enquanto o primeiro da fila não cabe, os seguintes
+    esperam também (arquivos pequenos não passam à frente de um grande para sempre)."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    def _fits(self, size: int) -> bool:
+        return self.used == 0 or self.used + size <= self.limit
+
+    def _admit(self):
+        while self._waiters and self._fits(self._waiters[0][0]):
+            size, future = self._waiters.popleft()
+            if not future.done():
+                self.used += size
+                future.set_result(None)
+
+    async def acquire(self, size: int):
+        if not self._waiters and self._fits(size):
+            self.used += size
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((size, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.used -= size  # admitido junto com o cancelamento: devolve
+            else:
+                self._waiters.remove((size, future))
+            self._admit()
+            raise
+
+    async def release(self, size: int):
+        self.used -= size
+        self._admit()
+
+
+class MessageResolver:
+    """Agrupa get_messages por chat: pedidos que chegam dentro de uma janela curta viram
+    uma única chamada get_messages(ids=[...]). Mensagens (e referências de arquivo)
+    ficam num cache de vida curta; apagadas viram negativo."""
+
+    def __init__(self, fetch, window_s: float, ttl_s: float):
+        self.fetch = fetch  # async (chat_id, ids) -> lista de mensagens na ordem de ids
+        self.window_s = window_s
+        self.cache = TTLCache(MESSAGE_CACHE_SIZE, ttl_s, ttl_s)
+        self._pending: dict[int, dict[int, asyncio.Future]] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def get(self, chat_id: int, message_id: int):
+        cached = self.cache.get((chat_id, message_id))
+        if cached is not MISSING:
+            return cached
+
+        pending = self._pending.setdefault(chat_id, {})
+        future = pending.get(message_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            pending[message_id] = future
+            if len(pending) >= MAX_IDS_PER_CALL:
+                self._dispatch(chat_id)
+            elif chat_id not in self._timers:
+                self._timers[chat_id] = asyncio.get_running_loop().call_later(
+                    self.window_s, self._dispatch, chat_id
+                )
+        return await asyncio.shield(future)
+
+    def invalidate(self, chat_id: int, message_id: int):
+        self.cache.invalidate((chat_id, message_id))
+
+    def _dispatch(self, chat_id: int):
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        batch = self._pending.pop(chat_id, None)
+        if batch:
+            task = asyncio.create_task(self._resolve(chat_id, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, chat_id: int, batch: dict[int, asyncio.Future]):
+        ids = list(batch)
+        try:
+            messages = await self.fetch(chat_id, ids)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for message_id, msg in zip(ids, messages):
+            self.cache.put((chat_id, message_id), msg)
+            if not batch[message_id].done():
+                batch[message_id].set_result(msg)
+        log.debug("mensagens_resolvidas", chat_id=chat_id, ids=len(ids))
+
+
+class Account:
+    """Uma sessão do Telegram com contabilidade própria de FLOOD_WAIT: bucket global,
+    buckets por chat e resolução de mensagens (access_hash/file_reference são por conta)"""
+
+    def __init__(self, session_name: str):
+        self.name = session_name
         self.client = TelegramClient(
-            f"{settings.telegram_session_name}_downloader",
+            session_name,
             settings.telegram_api_id,
             settings.telegram_api_hash,
-            flood_sleep_threshold=120,
+            flood_sleep_threshold=0,  # FLOOD_WAIT volta como exceção e pausa o bucket global
+        )
+        self.global_bucket = TokenBucket(settings.downloader_rate_global, GLOBAL_BURST)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.resolver = MessageResolver(
+            self._fetch_messages,
+            settings.downloader_resolve_window_ms / 1000,
+            settings.downloader_message_cache_s,
         )
+        self.active = 0  # downloads em andamento nesta conta
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(settings.downloader_rate_per_chat, CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    async def _fetch_messages(self, chat_id: int, ids: list[int]) -> list:
+        """Uma chamada (e um token) para todas as mensagens pendentes do chat"""
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+        return await self.client.get_messages(chat_id, ids=ids)
+
+    def flood_wait(self, seconds: int, **kw):
+        self.global_bucket.pause(seconds)
+        log.warning("flood_wait", conta=self.name, segundos=seconds, **kw)
+
+    def load(self) -> tuple[bool, int]:
+        """Ordenação do pool: contas fora de FLOOD_WAIT primeiro, depois a menos ocupada"""
+        return self.global_bucket.blocked_until > time.monotonic(), self.active
+
+
+def _hash_range(path: Path, sha256, offset: int, length: int):
+    """Lê de volta (page cache) um trecho já gravado e alimenta o hash em ordem"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(length, HASH_READ_BYTES))
+            if not data:
+                raise RuntimeError("trecho incompleto no staging")
+            sha256.update(data)
+            length -= len(data)
+
+
+class Downloader:
+    def __init__(self):
+        default_session = f"{settings.telegram_session_name}_downloader"
+        sessions = settings.download_sessions_list or [default_session]
+        self.accounts = [Account(name) for name in sessions]
         self.connection = None
         self.channel = None
         self.exchange = None
+        self.publisher = None
+        self.bytes_in_flight = ByteBudget(settings.downloader_max_inflight_mb * 1024 * 1024)
+        self.seen = None
+        self.large_file_bytes = settings.downloader_large_file_mb * 1024 * 1024
+        # Trechos múltiplos do tamanho de requisição do Telegram (offsets alinhados)
+        part_mb = settings.downloader_part_mb
+        self.part_bytes = max(1, part_mb * 1024 * 1024 // PART_CHUNK) * PART_CHUNK
 
     async def connect_telegram(self):
-        await self.client.start()
+        for account in self.accounts:
+            await account.client.start()
 
     async def connect_rabbitmq(self):
-        self.connection = await connect_robust(settings.rabbitmq_url)
-        self.channel = await self.connection.channel()
-        await self.channel.set_qos(prefetch_count=1)
+        self.connection, self.channel, self.exchange = await connect()
+        self.publisher = BatchPublisher(self.exchange)
 
-        self.exchange = await self.channel.declare_exchange(
-            "fastleaksdf", ExchangeType.TOPIC, durable=True
-        )
+    def _pick_account(self) -> Account:
+        """Documentos inteiros são distribuídos entre as contas do pool"""
+        return min(self.accounts, key=Account.load)
+
+    async def _stream_to(self, account: Account, media, staging: Path) -> str:
+        """Grava os chunks do Telegram direto no staging, atualizando o SHA-256 a cada um"""
+        sha256 = hashlib.sha256()
+        async with aiofiles.open(staging, "wb") as f:
+            async for chunk in account.client.iter_download(media):
+                sha256.update(chunk)
+                await f.write(chunk)
+        return sha256.hexdigest()
+
+    async def _fetch_part(
+        self, account: Account, media, fd: int, offset: int, length: int, doc_id: int
+    ):
+        """Baixa [offset, offset+length) gravando na posição certa do staging; após
+        FLOOD_WAIT retoma do último chunk gravado em vez de recomeçar o arquivo"""
+        pos, end = offset, offset + length
+        for attempt in range(FLOOD_RETRIES + 1):
+            await account.global_bucket.acquire()
+            try:
+                async for chunk in account.client.iter_download(
+                    media,
+                    offset=pos,
+                    limit=-(-(end - pos) // PART_CHUNK),
+                    chunk_size=PART_CHUNK,
+                    request_size=PART_CHUNK,
+                ):
+                    chunk = chunk[:end - pos]
+                    # pwrite de um chunk vai para o page cache; fica no loop para que um
+                    # cancelamento nunca deixe escrita pendente num fd já fechado
+                    os.pwrite(fd, chunk, pos)
+                    pos += len(chunk)
+                if pos < end:
+                    raise RuntimeError(f"trecho incompleto: {pos - offset}/{length} bytes")
+                return
+            except FloodWaitError as e:
+                account.flood_wait(e.seconds, doc_id=doc_id, offset=pos, tentativa=attempt + 1)
+                if attempt == FLOOD_RETRIES:
+                    raise
 
-        queue = await self.channel.declare_queue("documents.pending", durable=True)
-        await queue.bind(self.exchange, routing_key="documents.pending")
-        await self.channel.declare_queue("documents.downloaded", durable=True)
+    async def _stream_parts(
+        self, account: Account, media, staging: Path, size: int, doc_id: int
+    ) -> str:
+        """Modo arquivo grande: trechos baixados em paralelo (DOWNLOADER_PARTS) num staging
+        pré-alocado. O hash segue em ordem atrás dos downloads: cada trecho é relido do
+        page cache assim que ele e todos os anteriores terminam."""
+        step = self.part_bytes
+        ranges = [(off, min(step, size - off)) for off in range(0, size, step)]
+        done = [asyncio.Event() for _ in ranges]
+        slots = asyncio.Semaphore(settings.downloader_parts)
+        sha256 = hashlib.sha256()
 
-        return queue
+        async def fetch(i: int, offset: int, length: int):
+            async with slots:
+                await self._fetch_part(account, media, fd, offset, length, doc_id)
+            done[i].set()
 
-    async def download_document(self, tg_doc: TelegramDocument) -> Path:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(tg_doc.filename).suffix) as tmp:
-            temp_path = Path(tmp.name)
+        async def hash_in_order():
+            for (offset, length), event in zip(ranges, done):
+                await event.wait()
+                await asyncio.to_thread(_hash_range, staging, sha256, offset, length)
 
+        fd = os.open(staging, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        tasks = []
         try:
-            await self.client.download_media(
-                await self.client.get_messages(tg_doc.chat_id, ids=tg_doc.message_id),
-                file=temp_path,
-            )
-            return temp_path
+            os.ftruncate(fd, size)
+            tasks = [asyncio.create_task(fetch(i, *r)) for i, r in enumerate(ranges)]
+            tasks.append(asyncio.create_task(hash_in_order()))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.close(fd)
+        return sha256.hexdigest()
+
+    async def download_document(self, tg_doc: TelegramDocument) -> tuple[Path, str]:
+        """Baixa para o staging do storage; retorna (arquivo em staging, sha256)"""
+        staging = get_staging_path()
+        account = self._pick_account()
+        account.active += 1
+
+        try:
+            for attempt in range(FLOOD_RETRIES + 1):
+                try:
+                    message = await account.resolver.get(tg_doc.chat_id, tg_doc.message_id)
+                    if not message or not message.document:
+                        raise RuntimeError("mensagem sem documento")
+                    media = message.document
+                    if self.large_file_bytes and media.size >= self.large_file_bytes:
+                        sha256 = await self._stream_parts(
+                            account, media, staging, media.size, tg_doc.doc_id
+                        )
+                    else:
+                        await account.global_bucket.acquire()
+                        sha256 = await self._stream_to(account, media, staging)
+                    return staging, sha256
+                except FloodWaitError as e:
+                    account.flood_wait(e.seconds, doc_id=tg_doc.doc_id, tentativa=attempt + 1)
+                    if attempt == FLOOD_RETRIES:
+                        raise
         except Exception as e:
-            temp_path.unlink(missing_ok=True)
+            # Referência de arquivo pode ter expirado: a próxima tentativa busca de novo
+            account.resolver.invalidate(tg_doc.chat_id, tg_doc.message_id)
+            staging.unlink(missing_ok=True)
             raise RuntimeError(f"Download falhou: {e}") from e
+        finally:
+            account.active -= 1
 
-    async def process_message(self, message):
-        async with message.process():
-            try:
-                tg_doc = TelegramDocument.model_validate_json(message.body)
-                temp_file = await self.download_document(tg_doc)
-
-                sha256 = compute_sha256(temp_file)
-                storage_path = get_storage_path(sha256, tg_doc.filename)
-                storage_path.parent.mkdir(parents=True, exist_ok=True)
-                temp_file.rename(storage_path)
-
-                downloaded = DownloadedFile(
-                    job_id=tg_doc.job_id,
-                    doc_id=tg_doc.doc_id,
-                    sha256=sha256,
-                    storage_path=str(storage_path),
-                    size_bytes=tg_doc.size_bytes,
-                    mime_type=tg_doc.mime_type,
-                    extractable=is_extractable(tg_doc.mime_type, tg_doc.filename),
-                    original=tg_doc,
-                )
+    def _commit(self, staging: Path, sha256: str, filename: str) -> tuple[Path, Sniffed]:
+        """Classifica pelo começo do conteúdo e grava no blob store (roda numa thread).
 
-                await self.exchange.publish(
-                    Message(body=downloaded.model_dump_json().encode(), delivery_mode=2),
-                    routing_key="documents.downloaded",
-                )
+        Mesmo filesystem: link atômico, sem copiar nem reler; conteúdo já armazenado
+        (outro nome/canal) só ganha mais um nome; texto pode ser comprimido.
+        """
+        sniffed = sniff_file(staging)
+        storage_path, _ = get_blob_store().commit(staging, sha256, filename, text=sniffed.is_text)
+        return storage_path, sniffed
 
-                log.info(
-                    "download_concluido",
-                    sha256=sha256[:8],
-                    filename=tg_doc.filename,
-                    size_mb=round(tg_doc.size_bytes / 1024 / 1024, 2),
-                    extractable=downloaded.extractable,
-                )
+    def _already_seen(self, tg_doc: TelegramDocument) -> bool:
+        """Repost/encaminhamento de algo já baixado (e ainda no storage) → nada a fazer"""
+        if not self.seen:
+            return False
+        known = self.seen.lookup(
+            tg_doc.doc_id, tg_doc.size_bytes, tg_doc.filename, use_hints=settings.dedup_use_hints
+        )
+        if not known or not Path(known[1]).exists():
+            return False
+        log.info(
+            "documento_repetido",
+            doc_id=tg_doc.doc_id,
+            sha256=known[0][:8],
+            filename=tg_doc.filename,
+        )
+        return True
 
+    async def handle(self, tg_doc: TelegramDocument):
+        """Baixa, grava no blob store e publica o DownloadedFile"""
+        if self._already_seen(tg_doc):
+            return
+
+        await self.bytes_in_flight.acquire(tg_doc.size_bytes)
+        try:
+            staging, sha256 = await self.download_document(tg_doc)
+        finally:
+            await self.bytes_in_flight.release(tg_doc.size_bytes)
+
+        try:
+            storage_path, sniffed = await asyncio.to_thread(
+                self._commit, staging, sha256, tg_doc.filename
+            )
+        except BaseException:
+            staging.unlink(missing_ok=True)  # disco cheio, erro de compressão, cancelamento
+            raise
+
+        downloaded = DownloadedFile(
+            job_id=tg_doc.job_id,
+            doc_id=tg_doc.doc_id,
+            sha256=sha256,
+            storage_path=str(storage_path),
+            size_bytes=tg_doc.size_bytes,
+            mime_type=sniffed.mime,
+            extractable=sniffed.archive is not None,
+            original=tg_doc,
+        )
+
+        routing_key = lane_key("documents.downloaded", downloaded.size_bytes)
+        await self.publisher.publish(downloaded, routing_key)
+        if self.seen:
+            self.seen.add(
+                tg_doc.doc_id, tg_doc.size_bytes, tg_doc.filename, sha256, str(storage_path)
+            )
+
+        log.info(
+            "download_concluido",
+            sha256=sha256[:8],
+            filename=tg_doc.filename,
+            size_mb=round(tg_doc.size_bytes / 1024 / 1024, 2),
+            extractable=downloaded.extractable,
+        )
+
+    async def process_message(self, message):
+        async with message.process():
+            try:
+                tg_doc = decode(message, TelegramDocument)
+                await self.handle(tg_doc)
             except Exception as e:
                 log.exception("erro_download", doc_id=tg_doc.doc_id, error=str(e))
 
-    async def start(self):
+    async def prepare(self):
+        """Índice de documentos já baixados e conexão das contas do pool de download"""
+        if settings.dedup_index_path:
+            self.seen = SeenIndex(settings.dedup_index_path, settings.dedup_bloom_capacity)
         await self.connect_telegram()
-        queue = await self.connect_rabbitmq()
-        log.info("downloader_ativo", prefetch=1)
-        await queue.consume(self.process_message)
+
+    async def start(self):
+        await self.prepare()
+        await self.connect_rabbitmq()
+        log.info(
+            "downloader_ativo",
+            prefetch=settings.downloader_concurrency,
+            prefetch_large=settings.downloader_large_concurrency,
+            max_inflight_mb=settings.downloader_max_inflight_mb,
+            contas=[a.name for a in self.accounts],
+            arquivo_grande_mb=settings.downloader_large_file_mb,
+            trechos=settings.downloader_parts,
+        )
+        # Arquivos grandes em consumidor próprio: não seguram os pequenos na fila
+        await consume_lanes(
+            self.connection,
+            "documents.pending",
+            self.process_message,
+            {
+                "small": settings.downloader_concurrency,
+                "large": settings.downloader_large_concurrency,
+            },
+        )
         await asyncio.Event().wait()
 
     async def stop(self):
-        if self.client.is_connected():
-            await self.client.disconnect()
+        for account in self.accounts:
+            if account.client.is_connected():
+                await account.client.disconnect()
+        if self.publisher:
+            await self.publisher.close()
         if self.connection:
             await self.connection.close()
+        if self.seen:
+            self.seen.close()
+        get_blob_store().close()
         log.info("downloader_encerrado")
 
 
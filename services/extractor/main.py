@@ -1,19 +1,261 @@
 import asyncio
+import bz2
+import contextlib
+import gzip
+import hashlib
+import io
+import lzma
+import tarfile
+import threading
 import zipfile
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from queue import Empty, Queue
+
 import rarfile
-import tempfile
-from pathlib import Path
 import structlog
-from aio_pika import connect_robust, ExchangeType, Message
+
+from shared.cache import ManifestStore
 from shared.config import settings
+from shared.messaging import BatchPublisher, ConfirmWindow, connect, consume_lanes, lane_key
 from shared.models import DownloadedFile, ExtractedFile
-from shared.utils import compute_sha256, get_storage_path
+from shared.sniff import SNIFF_BYTES, Sniffed, sniff_bytes, sniff_file
+from shared.storage import get_blob_store, open_blob
+from shared.utils import archive_kind, get_staging_path
+from shared.wire import decode, header
+
+try:
+    import py7zr  # opcional: suporte a .7z
+except ImportError:
+    py7zr = None
 
 log = structlog.get_logger(service="extractor")
 
 MAX_EXTRACTED_SIZE = 100 * 1024 * 1024  # 100 MB
 MAX_RECURSION_DEPTH = 3
 MAX_FILES_PER_ARCHIVE = 1000
+READ_CHUNK = 1024 * 1024
+NESTED_IN_MEMORY = 32 * 1024 * 1024  # archives aninhados até aqui reabrem da memória
+SEVENZ_AHEAD = 2  # membros de 7z gravados à espera de publicação (buffers aninhados em memória)
+
+
+def _open_source(source):
+    """Archive no storage (caminho, descomprimido se for blob comprimido) ou aninhado já
+    em memória (buffer)"""
+    if isinstance(source, Path):
+        return open_blob(source, "rb")
+    return contextlib.nullcontext(source)
+
+
+def _zip_members(source, name):
+    with zipfile.ZipFile(source, "r") as zf:
+        for info in zf.infolist():
+            yield info.filename, info.is_dir(), lambda info=info: zf.open(info)
+
+
+def _rar_members(source, name):
+    with rarfile.RarFile(source, "r") as rf:
+        for info in rf.infolist():
+            yield info.filename, info.isdir(), lambda info=info: rf.open(info)
+
+
+def _tar_members(source, name):
+    """Modo stream (`r|*`): membros lidos em ordem, sem seek; compressão detectada"""
+    with _open_source(source) as f, tarfile.open(fileobj=f, mode="r|*") as tf:
+        for info in tf:
+            # Links, devices e fifos não têm conteúdo: tratados como diretório
+            yield info.name, not info.isfile(), lambda info=info: tf.extractfile(info)
+
+
+def _single_member(opener):
+    """.gz/.bz2/.xz sem tar: um único membro, com o nome sem a extensão"""
+    def members(source, name):
+        yield Path(name).stem, False, lambda: opener(source)
+    return members
+
+
+# Formato → gerador de (nome, é_diretório, abre_stream) na ordem do archive
+READERS = {
+    "zip": _zip_members,
+    "rar": _rar_members,
+    "tar": _tar_members,
+    "gz": _single_member(gzip.open),
+    "bz2": _single_member(bz2.open),
+    "xz": _single_member(lzma.open),
+}
+
+
+def _is_safe_name(name: str) -> bool:
+    """Nome de membro sem componentes absolutos nem `..` (nada é gravado nesse caminho,
+    mas um nome assim indica archive malicioso)"""
+    path = PurePosixPath(name.replace("\\", "/"))
+    return not path.is_absolute() and ".." not in path.parts
+
+
+def _archive_of(sniffed: Sniffed, filename: str) -> str | None:
+    """Formato pelo conteúdo; o nome só desempata .tar.bz2 (sniff vê apenas bz2)"""
+    if sniffed.archive in ("gz", "bz2", "xz") and archive_kind(filename) == "tar":
+        return "tar"
+    return sniffed.archive
+
+
+def _keep_for(depth: int) -> int:
+    """Bytes de um membro a manter em memória: só se ainda houver nível para abri-lo"""
+    return NESTED_IN_MEMORY if depth + 1 < MAX_RECURSION_DEPTH else 0
+
+
+class ExtractionLimits:
+    """Limites de um archive, sobre os bytes realmente descomprimidos (não o declarado)"""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+
+    def add_member(self):
+        self.files += 1
+        if self.files > MAX_FILES_PER_ARCHIVE:
+            raise ValueError("Limite de arquivos excedido")
+
+    def add_bytes(self, n: int):
+        self.bytes += n
+        if self.bytes > MAX_EXTRACTED_SIZE:
+            raise ValueError("Limite de tamanho excedido")
+
+
+class MemberSink:
+    """Destino de um membro: staging no filesystem do storage + SHA-256 calculado no
+    caminho + amostra inicial para o sniff. Com `keep`, um archive aninhado de até
+    `keep` bytes fica também em memória."""
+
+    def __init__(self, filename: str, keep: int = 0):
+        self.filename = filename
+        self.staging = get_staging_path()
+        self.file = None  # aberto na 1ª escrita: só o membro em andamento ocupa um fd
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.keep = keep
+        self.head = b""
+        self.buffer = None
+        self.sha256 = None
+        self.sniffed = None
+        self.storage = None
+
+    def write(self, data: bytes):
+        if not self.size and self.keep:
+            # O 1º chunk decide se vale guardar em memória (archive, mesmo renomeado)
+            if archive_kind(self.filename) or sniff_bytes(data[:SNIFF_BYTES]).archive:
+                self.buffer = io.BytesIO()
+        if len(self.head) < SNIFF_BYTES:
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+        self._hash.update(data)
+        if self.file is None:
+            self.file = open(self.staging, "wb")
+        self.file.write(data)
+        self.size += len(data)
+        if self.buffer is not None:
+            if self.size > self.keep:
+                self.buffer = None
+            else:
+                self.buffer.write(data)
+
+    def commit(self) -> Path:
+        """Fecha, classifica pelo conteúdo e grava no blob store (link atômico; conteúdo
+        repetido não ocupa disco; texto pode ser comprimido)"""
+        if self.file is None:
+            self.staging.touch()  # membro vazio
+        else:
+            self.file.close()
+        self.sha256 = self._hash.hexdigest()
+        self.sniffed = sniff_bytes(self.head)
+        storage, _ = get_blob_store().commit(
+            self.staging, self.sha256, self.filename, text=self.sniffed.is_text
+        )
+        if self.buffer is not None:
+            self.buffer.seek(0)
+        self.storage = storage
+        return storage
+
+    @property
+    def archive(self) -> str | None:
+        return _archive_of(self.sniffed, self.filename)
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+        self.staging.unlink(missing_ok=True)
+
+
+class _SinkIO:
+    """Interface Py7zIO do py7zr: o py7zr empurra os bytes, que vão direto ao MemberSink"""
+
+    def __init__(self, sink: MemberSink, factory: "_SinkFactory"):
+        self.sink = sink
+        self.factory = factory
+
+    def write(self, s) -> int:
+        if self.factory.cancelled.is_set():
+            raise ValueError("extração de 7z interrompida")
+        self.factory.limits.add_bytes(len(s))
+        self.sink.write(s)
+        return len(s)
+
+    def read(self, size=None) -> bytes:
+        return b""
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.sink.size
+
+    def seekable(self) -> bool:
+        return False
+
+    def flush(self):
+        pass
+
+    def size(self) -> int:
+        return self.sink.size
+
+    def close(self):
+        # py7zr >= 1.1 avisa o fim de cada membro aqui
+        if self.factory.current is self.sink:
+            self.factory.finish()
+
+
+class _SinkFactory:
+    """Interface WriterFactory do py7zr: um MemberSink por membro, na ordem extraída.
+    A extração é sequencial: o membro anterior está completo quando o próximo começa, e é
+    gravado no storage e entregue em `done` na hora (um staging aberto por vez, em
+    qualquer versão do py7zr)"""
+
+    def __init__(
+        self, limits: ExtractionLimits, depth: int, done: Queue, cancelled: threading.Event
+    ):
+        self.limits = limits
+        self.depth = depth
+        self.done = done
+        self.cancelled = cancelled
+        self.current: MemberSink | None = None
+
+    def create(self, filename: str) -> _SinkIO:
+        self.finish()
+        self.current = MemberSink(PurePosixPath(filename).name, _keep_for(self.depth))
+        return _SinkIO(self.current, self)
+
+    def finish(self):
+        """Grava o membro em andamento e o entrega ao consumidor"""
+        sink, self.current = self.current, None
+        if sink is not None:
+            try:
+                sink.commit()
+            except BaseException:
+                sink.discard()
+                raise
+            self.done.put(sink)
+
+    def discard(self):
+        if self.current is not None:
+            self.current.discard()
+            self.current = None
 
 
 class SafeExtractor:
@@ -21,182 +263,301 @@ class SafeExtractor:
         self.connection = None
         self.channel = None
         self.exchange = None
+        self.publisher = None
+        # zlib/unrar/hash/escrita liberam o GIL: threads bastam e mantêm o streaming simples
+        self.pool = ThreadPoolExecutor(
+            max_workers=settings.extractor_workers, thread_name_prefix="extractor"
+        )
+        self.manifests = None
 
     async def connect_rabbitmq(self):
-        self.connection = await connect_robust(settings.rabbitmq_url)
-        self.channel = await self.connection.channel()
-        await self.channel.set_qos(prefetch_count=1)
-
-        self.exchange = await self.channel.declare_exchange(
-            "fastleaksdf", ExchangeType.TOPIC, durable=True
+        self.connection, self.channel, self.exchange = await connect()
+        self.publisher = BatchPublisher(self.exchange)
+
+    def _replay(self, archive_sha256: str, job_id, depth: int) -> Iterator[ExtractedFile] | None:
+        """Filhos de um archive já extraído, a partir do manifesto (None = extrair)"""
+        members = self.manifests.get(archive_sha256) if self.manifests else None
+        if members is None or not all(Path(m["storage_path"]).exists() for m in members):
+            return None
+        log.debug(
+            "manifesto_reusado", sha256=archive_sha256[:8], membros=len(members), profundidade=depth
         )
+        return self._emit(members, archive_sha256, job_id, depth)
+
+    def _emit(
+        self, members: list[dict], parent_sha256: str, job_id, depth: int
+    ) -> Iterator[ExtractedFile]:
+        for m in members:
+            yield ExtractedFile(
+                job_id=job_id,
+                parent_sha256=parent_sha256,
+                sha256=m["sha256"],
+                storage_path=m["storage_path"],
+                filename=m["filename"],
+                mime_type=m.get("mime_type", "application/octet-stream"),
+                depth=depth + 1,
+                # Manifestos anteriores às lanes: tamanho em disco (comprimido ou não)
+                size_bytes=m.get("size_bytes") or Path(m["storage_path"]).stat().st_size,
+            )
+            # Manifestos anteriores ao sniff não têm "archive": vale o nome
+            kind = m.get("archive", archive_kind(m["filename"]))
+            yield from self._walk_nested(
+                Path(m["storage_path"]), kind, m["filename"], m["sha256"], job_id, depth + 1
+            )
 
-        queue = await self.channel.declare_queue("documents.downloaded", durable=True)
-        await queue.bind(self.exchange, routing_key="documents.downloaded")
-        await self.channel.declare_queue("files.extracted", durable=True)
-
-        return queue
-
-    def _is_safe_path(self, base: Path, target: Path) -> bool:
+    def _walk_nested(
+        self, source, kind: str | None, name: str, sha256: str, job_id, depth: int
+    ) -> Iterator[ExtractedFile]:
+        """Falha num archive aninhado não interrompe o archive pai"""
+        if not kind:
+            return
+        try:
+            yield from self._walk(source, kind, name, sha256, job_id, depth)
+        except Exception as e:
+            log.exception("extracao_falhou", sha256=sha256[:8], error=str(e))
+
+    def _store_members(
+        self, source, kind: str, name: str, depth: int
+    ) -> Iterator[tuple[MemberSink, Path]]:
+        """Membros em streaming (zip/rar/tar/gz/bz2/xz): cada um é lido, hasheado e gravado
+        no storage numa passada só, em ordem. Retorna (sink, caminho no storage)."""
+        limits = ExtractionLimits()
+        for member, is_dir, open_member in READERS[kind](source, name):
+            limits.add_member()
+            if is_dir:
+                continue
+            if not _is_safe_name(member):
+                log.warning("traversal_bloqueado", formato=kind, filename=member)
+                continue
+
+            sink = MemberSink(PurePosixPath(member.replace("\\", "/")).name, _keep_for(depth))
+            try:
+                with open_member() as stream:
+                    while chunk := stream.read(READ_CHUNK):
+                        limits.add_bytes(len(chunk))
+                        sink.write(chunk)
+                storage = sink.commit()
+            except BaseException:
+                sink.discard()
+                raise
+            yield sink, storage
+
+    @staticmethod
+    def _extract_7z(source, factory: _SinkFactory):
+        """Roda numa thread própria: o py7zr chama o factory de dentro de `extract`, e
+        cada membro gravado segue para `factory.done`; no fim, None ou a exceção"""
+        try:
+            # Sempre como file object: o py7zr extrai sequencialmente, numa thread só
+            with _open_source(source) as f, py7zr.SevenZipFile(f, "r") as szf:
+                targets = []
+                for info in szf.list():
+                    factory.limits.add_member()
+                    if info.is_directory:
+                        continue
+                    if not _is_safe_name(info.filename):
+                        log.warning("traversal_bloqueado", formato="7z", filename=info.filename)
+                        continue
+                    targets.append(info.filename)
+                if targets:
+                    szf.extract(targets=targets, factory=factory)
+            factory.finish()  # py7zr 1.0 não avisa o fim do último membro
+        except BaseException as e:
+            factory.discard()
+            factory.done.put(e)
+        else:
+            factory.done.put(None)
+
+    def _store_7z(self, source, depth: int) -> Iterator[tuple[MemberSink, Path]]:
+        """7z via py7zr com WriterFactory: os blocos (sólidos) são descomprimidos em ordem e
+        empurrados para um MemberSink por membro. Como nos outros formatos, cada membro sai
+        assim que é gravado, e os já gravados saem antes de um limite estourado"""
+        if py7zr is None:
+            raise ValueError("py7zr não instalado: extração de .7z indisponível")
+
+        cancelled = threading.Event()
+        factory = _SinkFactory(ExtractionLimits(), depth, Queue(SEVENZ_AHEAD), cancelled)
+        worker = threading.Thread(
+            target=self._extract_7z, args=(source, factory), name="extractor-7z"
+        )
+        worker.start()
         try:
-            return target.resolve().is_relative_to(base.resolve())
-        except ValueError:
-            return False
-
-    async def _extract_zip(self, path: Path, output: Path) -> list[Path]:
-        extracted = []
-        total = 0
-        count = 0
-
-        with zipfile.ZipFile(path, "r") as zf:
-            for info in zf.infolist():
-                count += 1
-                if count > MAX_FILES_PER_ARCHIVE:
-                    raise ValueError("Limite de arquivos excedido")
-
-                if ".." in info.filename or info.filename.startswith(("/", "\\")):
-                    log.warning("zip_traversal_bloqueado", filename=info.filename)
-                    continue
-
-                target = output / info.filename
-                if not self._is_safe_path(output, target):
-                    log.warning("caminho_inseguro", filename=info.filename)
-                    continue
-
-                total += info.file_size
-                if total > MAX_EXTRACTED_SIZE:
-                    raise ValueError("Limite de tamanho excedido")
-
-                zf.extract(info, output)
-                if not info.is_dir():
-                    extracted.append(target)
-
-        return extracted
-
-    async def _extract_rar(self, path: Path, output: Path) -> list[Path]:
-        extracted = []
-        total = 0
-        count = 0
-
-        with rarfile.RarFile(path, "r") as rf:
-            for info in rf.infolist():
-                count += 1
-                if count > MAX_FILES_PER_ARCHIVE:
-                    raise ValueError("Limite de arquivos excedido")
-
-                if ".." in info.filename or info.filename.startswith(("/", "\\")):
-                    log.warning("rar_traversal_bloqueado", filename=info.filename)
-                    continue
-
-                target = output / info.filename
-                if not self._is_safe_path(output, target):
-                    log.warning("caminho_inseguro", filename=info.filename)
-                    continue
-
-                total += info.file_size
-                if total > MAX_EXTRACTED_SIZE:
-                    raise ValueError("Limite de tamanho excedido")
-
-                rf.extract(info, output)
-                if not info.isdir():
-                    extracted.append(target)
-
-        return extracted
-
-    async def extract_recursive(self, downloaded: DownloadedFile, depth: int = 0) -> list[ExtractedFile]:
+            while (item := factory.done.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                yield item, item.storage
+        finally:
+            # Consumidor parou antes do fim: interrompe a extração e esvazia a fila
+            cancelled.set()
+            while worker.is_alive():
+                with contextlib.suppress(Empty):
+                    factory.done.get(timeout=0.1)
+            worker.join()
+
+    def _walk(
+        self, source, kind: str, name: str, parent_sha256: str, job_id, depth: int
+    ) -> Iterator[ExtractedFile]:
+        """Extrai `source` (caminho ou buffer em memória) membro a membro, sem diretório
+        temporário. Cada membro é classificado pelo conteúdo (mime, archive aninhado);
+        archives aninhados pequenos são reabertos direto da memória e archives com
+        manifesto não são abertos."""
         if depth >= MAX_RECURSION_DEPTH:
-            return []
+            return
+
+        replay = self._replay(parent_sha256, job_id, depth)
+        if replay is not None:
+            yield from replay
+            return
+
+        if kind == "7z":
+            stored = self._store_7z(source, depth)
+        else:
+            stored = self._store_members(source, kind, name, depth)
+
+        members = []
+        for sink, storage in stored:
+            members.append({
+                "sha256": sink.sha256,
+                "storage_path": str(storage),
+                "filename": sink.filename,
+                "mime_type": sink.sniffed.mime,
+                "archive": sink.archive,
+                "size_bytes": sink.size,
+            })
+            yield ExtractedFile(
+                job_id=job_id,
+                parent_sha256=parent_sha256,
+                sha256=sink.sha256,
+                storage_path=str(storage),
+                filename=sink.filename,
+                mime_type=sink.sniffed.mime,
+                depth=depth + 1,
+                size_bytes=sink.size,
+            )
+            nested = sink.buffer if sink.buffer is not None else storage
+            yield from self._walk_nested(
+                nested, sink.archive, sink.filename, sink.sha256, job_id, depth + 1
+            )
+
+        # Só archives extraídos por inteiro (limites estourados ou erro → extrai de novo)
+        if self.manifests:
+            self.manifests.put(parent_sha256, members)
 
+    def iter_extracted(self, downloaded: DownloadedFile) -> Iterator[ExtractedFile]:
         archive = Path(downloaded.storage_path)
         if not archive.exists():
-            return []
-
-        results = []
-        with tempfile.TemporaryDirectory(prefix="fastleaks_extract_") as tmpdir:
-            output = Path(tmpdir)
-
-            try:
-                if archive.suffix.lower() == ".zip":
-                    files = await self._extract_zip(archive, output)
-                elif archive.suffix.lower() == ".rar":
-                    files = await self._extract_rar(archive, output)
-                else:
-                    return []
-
-                for f in files:
-                    sha256 = compute_sha256(f)
-                    storage = get_storage_path(sha256, f.name)
-                    storage.parent.mkdir(parents=True, exist_ok=True)
-                    f.rename(storage)
-
-                    ef = ExtractedFile(
-                        job_id=downloaded.job_id,
-                        parent_sha256=downloaded.sha256,
-                        sha256=sha256,
-                        storage_path=str(storage),
-                        filename=f.name,
-                        mime_type="application/octet-stream",
-                        depth=depth + 1,
-                    )
-                    results.append(ef)
-
-                    if f.suffix.lower() in (".zip", ".rar", ".7z"):
-                        nested = await self.extract_recursive(
-                            DownloadedFile(
-                                job_id=downloaded.job_id,
-                                doc_id=downloaded.doc_id,
-                                sha256=sha256,
-                                storage_path=str(storage),
-                                size_bytes=storage.stat().st_size,
-                                mime_type="application/octet-stream",
-                                extractable=True,
-                                original=downloaded.original,
-                            ),
-                            depth=depth + 1,
-                        )
-                        results.extend(nested)
-
-            except Exception as e:
-                log.exception("extracao_falhou", sha256=downloaded.sha256[:8], error=str(e))
+            return
+        try:
+            # Formato pelo conteúdo: archives renomeados também são abertos
+            kind = _archive_of(sniff_file(archive), downloaded.original.filename)
+            if kind:
+                yield from self._walk(
+                    archive,
+                    kind,
+                    downloaded.original.filename,
+                    downloaded.sha256,
+                    downloaded.job_id,
+                    0,
+                )
+        except Exception as e:
+            log.exception("extracao_falhou", sha256=downloaded.sha256[:8], error=str(e))
+
+    def _produce(
+        self, downloaded: DownloadedFile, queue: asyncio.Queue, loop, cancelled: threading.Event
+    ):
+        """Roda no pool: entrega cada ExtractedFile ao event loop assim que chega ao storage"""
+        try:
+            for ef in self.iter_extracted(downloaded):
+                if cancelled.is_set():
+                    return
+                loop.call_soon_threadsafe(queue.put_nowait, ef)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def extract_and_publish(self, downloaded: DownloadedFile) -> int:
+        """Descompressão no pool de threads; publicação em lotes à medida que os membros
+        saem, para o scanner começar pelo primeiro arquivo sem esperar o archive inteiro.
+        O ack do archive espera a confirmação de todos os membros; no máximo
+        PUBLISH_BATCH_SIZE ficam pendentes ao mesmo tempo"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        producer = loop.run_in_executor(
+            self.pool, self._produce, downloaded, queue, loop, cancelled
+        )
 
-        if results:
+        confirms = ConfirmWindow()
+        published = depth = 0
+        try:
+            while (ef := await queue.get()) is not None:
+                routing_key = lane_key("files.extracted", ef.size_bytes)
+                await confirms.add(self.publisher.send(ef, routing_key))
+                published += 1
+                depth = max(depth, ef.depth)
+            await confirms.wait()
+        finally:
+            cancelled.set()  # erro ou cancelamento → o worker para no próximo membro
+            await producer
+
+        if published:
             log.info(
                 "extracao_concluida",
                 original=downloaded.sha256[:8],
-                extraidos=len(results),
+                extraidos=published,
                 profundidade=depth,
             )
-        return results
+        return published
+
+    async def handle(self, downloaded: DownloadedFile):
+        if downloaded.extractable:
+            await self.extract_and_publish(downloaded)
 
     async def process_message(self, message):
         async with message.process():
             try:
-                downloaded = DownloadedFile.model_validate_json(message.body)
-                if not downloaded.extractable:
+                # Roteamento pelo header: a maioria dos downloads não é archive
+                if header(message, "extractable") is False:
                     return
-
-                extracted = await self.extract_recursive(downloaded, depth=0)
-                for ef in extracted:
-                    await self.exchange.publish(
-                        Message(body=ef.model_dump_json().encode(), delivery_mode=2),
-                        routing_key="files.extracted",
-                    )
+                await self.handle(decode(message, DownloadedFile))
             except Exception as e:
                 log.exception("erro_processamento", error=str(e))
 
+    def prepare(self):
+        """Manifesto de archives já extraídos (reemissão dos filhos sem descomprimir)"""
+        if settings.extract_manifest_path:
+            self.manifests = ManifestStore(
+                settings.extract_manifest_path, settings.extract_manifest_max_entries
+            )
+
     async def start(self):
-        queue = await self.connect_rabbitmq()
+        self.prepare()
+        await self.connect_rabbitmq()
         log.info(
             "extractor_ativo",
             max_size_mb=MAX_EXTRACTED_SIZE // 1024 // 1024,
             max_depth=MAX_RECURSION_DEPTH,
+            workers=settings.extractor_workers,
+            prefetch=settings.extractor_prefetch,
+            prefetch_large=settings.extractor_large_prefetch,
+        )
+        # Cópia própria de documents.downloaded (a fila documents.downloaded é do scanner);
+        # prefetch = archives processados ao mesmo tempo (cada um ocupa um worker do pool)
+        await consume_lanes(
+            self.connection,
+            "documents.extract",
+            self.process_message,
+            {"small": settings.extractor_prefetch, "large": settings.extractor_large_prefetch},
         )
-        await queue.consume(self.process_message)
         await asyncio.Event().wait()
 
     async def stop(self):
+        if self.publisher:
+            await self.publisher.close()
         if self.connection:
             await self.connection.close()
+        self.pool.shutdown(cancel_futures=True)
+        if self.manifests:
+            self.manifests.close()
+        get_blob_store().close()
         log.info("extractor_encerrado")
 
 
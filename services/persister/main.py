@@ -1,31 +1,85 @@
 import asyncio
-import structlog
+import hashlib
 from datetime import datetime
-from sqlmodel import create_engine, Session, select
-from aio_pika import connect_robust, ExchangeType
+
+import structlog
+from aio_pika import DeliveryMode, Message
+from aio_pika.abc import AbstractIncomingMessage
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, col, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from shared.cache import MISSING, TTLCache
 from shared.config import settings
-from shared.models import IOCMatch, TelegramSource, Document, IOC, TelegramDocument
+from shared.messaging import DLX, IOC_DEAD_LETTER_QUEUE, connect
+from shared.models import IOC, Document, IOCBatch, IOCMatch, TelegramDocument, TelegramSource
+from shared.wire import decode
 
 log = structlog.get_logger(service="persister")
 
+INSERT_CHUNK = 5000      # linhas por INSERT (limite de parâmetros do PostgreSQL)
+RETRY_BACKOFF_S = 5      # pausa antes de devolver mensagens que falharam à fila
+MIN_PREFETCH = 64        # mensagens não ackadas, no mínimo (arquivos com poucos IOCs)
+
+# Banco fora do ar, conexão caída, pool esgotado: a mensagem não tem culpa
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError, OSError, TimeoutError)
+
+
+def _is_transient(error: Exception) -> bool:
+    return isinstance(error, TRANSIENT_ERRORS) or getattr(error, "connection_invalidated", False)
+
+
+def _async_url(url: str) -> str:
+    """postgresql://... → postgresql+asyncpg://..."""
+    scheme, rest = url.split("://", 1)
+    return f"{scheme.split('+')[0]}+asyncpg://{rest}"
+
 
 class Persister:
     def __init__(self):
-        self.engine = create_engine(settings.database_url, pool_pre_ping=True, pool_size=5, max_overflow=10)
+        pool = {
+            "pool_pre_ping": True,
+            "pool_size": settings.database_pool_size,
+            "max_overflow": settings.database_max_overflow,
+        }
+        if settings.database_async:
+            self.engine = create_async_engine(_async_url(settings.database_url), **pool)
+        else:
+            self.engine = create_engine(settings.database_url, **pool)
         self.connection = None
         self.channel = None
+        self.dlx = None  # sem broker (pipeline embutido): mensagens descartadas só são logadas
+        # (mensagem, sha256 do arquivo, IOCs): IOCMatch avulso ou os matches de um IOCBatch
+        self._batch: list[tuple[AbstractIncomingMessage, str, list]] = []
+        self._batch_items = 0
+        # Lotes gravando em paralelo: um por conexão do pool
+        self._inflight = asyncio.Semaphore(settings.database_pool_size)
+        self._flusher = None
+        # Identidades estáveis: milhares de IOCs do mesmo arquivo repetem o mesmo sha256
+        size, ttl = settings.persister_cache_size, settings.persister_cache_ttl_s
+        self.doc_ids = TTLCache(size, ttl, settings.persister_negative_ttl_s)
+        self.source_ids = TTLCache(size, ttl, settings.persister_negative_ttl_s)
+        # Gravações falhas por mensagem (hash do corpo): a fila clássica não conta entregas
+        self.attempts = TTLCache(size, ttl, ttl)
 
     async def connect_rabbitmq(self):
-        self.connection = await connect_robust(settings.rabbitmq_url)
-        self.channel = await self.connection.channel()
-        await self.channel.set_qos(prefetch_count=5)
-
-        exchange = await self.channel.declare_exchange("fastleaksdf", ExchangeType.TOPIC, durable=True)
-        queue = await self.channel.declare_queue("iocs.pending", durable=True)
-        await queue.bind(exchange, routing_key="iocs.pending")
-        return queue
+        # Um lote por conexão do pool em voo + um enchendo enquanto os outros gravam.
+        # Com IOCBatch cada mensagem já traz até SCANNER_BATCH_MAX_MATCHES IOCs.
+        per_message = settings.scanner_batch_max_matches if settings.scanner_publish_batches else 1
+        in_flight = settings.persister_batch_size * (settings.database_pool_size + 1)
+        prefetch = max(MIN_PREFETCH, in_flight // per_message)
+        self.connection, self.channel, _ = await connect(prefetch)
+        self.dlx = await self.channel.get_exchange(DLX)
+        return await self.channel.get_queue("iocs.pending")
 
     def _get_source_id(self, session: Session, tg_doc: TelegramDocument) -> int:
+        cached = self.source_ids.get(tg_doc.doc_id)
+        if cached is not MISSING and cached is not None:
+            return cached
+
         stmt = select(TelegramSource).where(TelegramSource.doc_id == tg_doc.doc_id)
         source = session.exec(stmt).first()
         if not source:
@@ -41,9 +95,16 @@ class Persister:
             )
             session.add(source)
             session.commit()
+        self.source_ids.put(tg_doc.doc_id, source.id)
         return source.id
 
-    def _get_document_id(self, session: Session, sha256: str, source_id: int, path: str, mime: str, size: int) -> int:
+    def _get_document_id(
+        self, session: Session, sha256: str, source_id: int, path: str, mime: str, size: int
+    ) -> int:
+        cached = self.doc_ids.get(sha256)
+        if cached is not MISSING and cached is not None:
+            return cached
+
         stmt = select(Document).where(Document.sha256 == sha256)
         doc = session.exec(stmt).first()
         if not doc:
@@ -56,62 +117,235 @@ class Persister:
             )
             session.add(doc)
             session.commit()
+        self.doc_ids.put(sha256, doc.id)
         return doc.id
 
-    def _ioc_exists(self, session: Session, doc_id: int, ioc_type: str, value: str) -> bool:
-        stmt = select(IOC).where(IOC.document_id == doc_id, IOC.ioc_type == ioc_type, IOC.value == value)
-        return session.exec(stmt).first() is not None
+    def _lookup_documents(self, session: Session, shas: set[str]) -> dict[str, int | None]:
+        """sha256 → document_id via cache; só os misses vão ao banco, num único SELECT"""
+        found, misses = {}, []
+        for sha in shas:
+            cached = self.doc_ids.get(sha)
+            if cached is MISSING:
+                misses.append(sha)
+            else:
+                found[sha] = cached
 
-    async def process_message(self, message):
-        async with message.process():
+        if misses:
+            stmt = select(Document.sha256, Document.id).where(col(Document.sha256).in_(misses))
+            rows = dict(session.exec(stmt).all())
+            for sha in misses:
+                # Ausente vira negativo de TTL curto: o documento pode ainda estar a caminho
+                found[sha] = rows.get(sha)
+                self.doc_ids.put(sha, found[sha])
+        return found
+
+    def _write_batch(self, session: Session, entries: list[tuple[str, list]]) -> tuple[int, int]:
+        """Um SELECT para os documentos do lote + INSERT multi-linha com ON CONFLICT.
+
+        `entries` são pares (sha256 do arquivo, IOCs). A deduplicação fica com a
+        constraint única (document_id, ioc_type, value). Retorna (inseridos, sem_documento).
+        """
+        doc_ids = self._lookup_documents(session, {sha256 for sha256, _ in entries})
+
+        rows, seen, missing = [], set(), 0
+        now = datetime.utcnow()
+        for sha256, hits in entries:
+            doc_id = doc_ids.get(sha256)
+            if doc_id is None:
+                missing += len(hits)
+                continue
+            for m in hits:
+                key = (doc_id, m.ioc_type, m.value)
+                if key in seen:
+                    continue
+                seen.add(key)
+                rows.append({
+                    "document_id": doc_id,
+                    "ioc_type": m.ioc_type,
+                    "value": m.value,
+                    "context": m.context,
+                    "line_number": m.line_number,
+                    "created_at": now,
+                })
+
+        inserted = 0
+        for i in range(0, len(rows), INSERT_CHUNK):
+            stmt = pg_insert(IOC).values(rows[i:i + INSERT_CHUNK]).on_conflict_do_nothing(
+                index_elements=["document_id", "ioc_type", "value"]
+            )
+            inserted += session.execute(stmt).rowcount
+        session.commit()
+        return inserted, missing
+
+    def _run_sync_session(self, fn, *args):
+        with Session(self.engine) as session:
+            return fn(session, *args)
+
+    async def _run_in_session(self, fn, *args):
+        """Executa `fn(session, *args)` sem bloquear o event loop: no engine asyncpg via
+        run_sync, no engine síncrono numa thread"""
+        if settings.database_async:
+            async with AsyncSession(self.engine) as session:
+                return await session.run_sync(fn, *args)
+        return await asyncio.to_thread(self._run_sync_session, fn, *args)
+
+    async def flush(self):
+        """Grava o lote pendente; as mensagens só são ackadas após o commit (at-least-once)"""
+        batch, self._batch = self._batch, []
+        items, self._batch_items = self._batch_items, 0
+        if not batch:
+            return
+
+        failed, retry = [], []
+        async with self._inflight:
+            try:
+                entries = [(sha256, hits) for _, sha256, hits in batch]
+                inserted, missing = await self._run_in_session(self._write_batch, entries)
+            except Exception as e:
+                log.exception("erro_persistencia", lote=items, mensagens=len(batch), error=str(e))
+                if _is_transient(e):
+                    retry = [message for message, _, _ in batch]
+                else:
+                    failed, retry = await self._write_each(batch)
+            else:
+                for message, _, _ in batch:
+                    await message.ack()
+
+                if missing:
+                    log.warning("documento_nao_encontrado", iocs=missing)
+                log.info(
+                    "iocs_persistidos",
+                    lote=items,
+                    mensagens=len(batch),
+                    inseridos=inserted,
+                    duplicados=items - inserted - missing,
+                    cache_documentos=self.doc_ids.stats(),
+                    cache_fontes=self.source_ids.stats(),
+                )
+
+        # Fora do semáforo: a pausa não segura uma conexão do pool
+        if failed or retry:
+            await self._settle(failed, retry)
+
+    async def _write_each(
+        self, batch: list[tuple[AbstractIncomingMessage, str, list]]
+    ) -> tuple[list[tuple[AbstractIncomingMessage, Exception]], list[AbstractIncomingMessage]]:
+        """Lote que falhou pelos dados: grava mensagem por mensagem, para uma mensagem
+        problemática não travar as outras; as que gravam recebem ack. Devolve (falhas,
+        a repetir): um erro transitório interrompe a passada e o resto volta inteiro"""
+        failed = []
+        for i, (message, sha256, hits) in enumerate(batch):
             try:
-                ioc_match = IOCMatch.model_validate_json(message.body)
-
-                with Session(self.engine) as session:
-                    # Busca documento para obter source_id
-                    stmt = select(Document).where(Document.sha256 == ioc_match.file_sha256)
-                    doc = session.exec(stmt).first()
-                    if not doc:
-                        log.warning("documento_nao_encontrado", sha256=ioc_match.file_sha256[:8])
-                        return
-
-                    # Deduplicação
-                    if self._ioc_exists(session, doc.id, ioc_match.ioc_type, ioc_match.value):
-                        log.debug("ioc_duplicado", sha256=ioc_match.file_sha256[:8], tipo=ioc_match.ioc_type)
-                        return
-
-                    # Persiste
-                    ioc = IOC(
-                        document_id=doc.id,
-                        ioc_type=ioc_match.ioc_type,
-                        value=ioc_match.value,
-                        context=ioc_match.context,
-                        line_number=ioc_match.line_number,
-                        created_at=datetime.utcnow(),
-                    )
-                    session.add(ioc)
-                    session.commit()
-
-                    log.info(
-                        "ioc_persistido",
-                        ioc_id=ioc.id,
-                        tipo=ioc.ioc_type,
-                        documento=ioc_match.file_sha256[:8],
-                        valor_preview=ioc.value[:32],
-                    )
+                await self._run_in_session(self._write_batch, [(sha256, hits)])
+            except Exception as e:
+                if _is_transient(e):
+                    return failed, [message for message, _, _ in batch[i:]]
+                failed.append((message, e))
+            else:
+                await message.ack()
+        return failed, []
+
+    async def _settle(
+        self,
+        failed: list[tuple[AbstractIncomingMessage, Exception]],
+        retry: list[AbstractIncomingMessage],
+    ):
+        """Depois da pausa, devolve as mensagens à fila. Erros transitórios não contam
+        tentativa (o banco volta e elas gravam); os demais contam, e a mensagem que chega a
+        PERSISTER_MAX_ATTEMPTS vai para iocs.failed"""
+        log.warning(
+            "mensagens_com_erro",
+            com_erro=len(failed),
+            a_repetir=len(retry),
+            error=str(failed[0][1]) if failed else None,
+        )
+        await asyncio.sleep(RETRY_BACKOFF_S)
+        for message in retry:
+            await message.nack(requeue=True)
+        for message, error in failed:
+            key = hashlib.blake2b(message.body, digest_size=16).digest()
+            attempts = self.attempts.get(key)
+            attempts = 1 if attempts is MISSING else attempts + 1
+            if attempts < settings.persister_max_attempts:
+                self.attempts.put(key, attempts)
+                await message.nack(requeue=True)
+            else:
+                self.attempts.invalidate(key)
+                await self._dead_letter(message, error, attempts)
 
+    async def _dead_letter(self, message, error: Exception, attempts: int = 0):
+        """Copia a mensagem para iocs.failed (com o erro num header) e a remove da fila"""
+        log.error(
+            "mensagem_descartada", fila=IOC_DEAD_LETTER_QUEUE, tentativas=attempts, error=str(error)
+        )
+        if self.dlx:
+            failed = Message(
+                body=message.body,
+                content_type=message.content_type,
+                type=message.type,
+                headers={**(message.headers or {}), "x-error": str(error)[:1000]},
+                delivery_mode=DeliveryMode.PERSISTENT,
+            )
+            try:
+                await self.dlx.publish(failed, routing_key=IOC_DEAD_LETTER_QUEUE)
             except Exception as e:
-                log.exception("erro_persistencia", error=str(e))
+                log.exception("erro_dead_letter", error=str(e))
+                await message.nack(requeue=True)
+                return
+        await message.reject(requeue=False)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(settings.persister_batch_ms / 1000)
+            await self.flush()
+
+    async def process_message(self, message):
+        try:
+            if message.type == "IOCBatch":
+                ioc_batch = decode(message, IOCBatch)
+                sha256, hits = ioc_batch.file_sha256, ioc_batch.matches
+            else:
+                ioc_match = decode(message, IOCMatch)
+                sha256, hits = ioc_match.file_sha256, [ioc_match]
+        except Exception as e:
+            log.exception("mensagem_invalida", error=str(e))
+            await self._dead_letter(message, e)
+            return
+        await self.add(message, sha256, hits)
+
+    async def add(self, message, sha256: str, hits: list):
+        """Entra no lote; `message` recebe ack quando o lote é gravado (nack/reject se falhar)"""
+        self._batch.append((message, sha256, hits))
+        self._batch_items += len(hits)
+        if self._batch_items >= settings.persister_batch_size:
+            await self.flush()
+
+    def prepare(self):
+        """Tarefa que grava lotes incompletos a cada PERSISTER_BATCH_MS"""
+        self._flusher = asyncio.create_task(self._flush_periodically())
 
     async def start(self):
         queue = await self.connect_rabbitmq()
-        log.info("persister_ativo", db_url=settings.database_url.split("@")[0] + "@...")
+        log.info(
+            "persister_ativo",
+            db_url=settings.database_url.split("@")[0] + "@...",
+            lote=settings.persister_batch_size,
+            lote_ms=settings.persister_batch_ms,
+        )
+        self.prepare()
         await queue.consume(self.process_message)
         await asyncio.Event().wait()
 
     async def stop(self):
+        if self._flusher:
+            self._flusher.cancel()
+        await self.flush()
         if self.connection:
             await self.connection.close()
+        if settings.database_async:
+            await self.engine.dispose()
+        else:
+            self.engine.dispose()
         log.info("persister_encerrado")
 
 
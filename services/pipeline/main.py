@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import hashlib
+import importlib
+import time
+from collections.abc import Awaitable
+from pathlib import Path
+from typing import ClassVar
+
+import structlog
+
+from services.extractor.main import SafeExtractor
+from services.scanner.main import Scanner
+from shared.config import settings
+from shared.models import DownloadedFile, IOCBatch, TelegramDocument
+from shared.sniff import sniff_file
+from shared.storage import get_blob_store
+from shared.utils import get_staging_path
+
+log = structlog.get_logger(service="pipeline")
+
+COPY_CHUNK = 1024 * 1024
+
+
+class LocalPublisher:
+    """Mesma interface do BatchPublisher (send/publish/close), mas entrega os modelos direto
+    nas filas do processo: sem serialização, broker nem rede. As lanes não se aplicam
+    (o sufixo .small/.large da routing key é ignorado)"""
+
+    def __init__(self, routes: dict[str, list[asyncio.Queue]]):
+        self.routes = routes
+
+    def send(self, model, routing_key: str) -> Awaitable:
+        """A entrega só acontece quando o retorno é esperado (no lugar da confirmação do
+        broker): com a fila cheia, quem publica espera — backpressure até a origem"""
+        base = routing_key.removesuffix(".small").removesuffix(".large")
+        return self._put(base, model)
+
+    async def _put(self, base: str, model):
+        for queue in self.routes[base]:
+            await queue.put(model)
+
+    async def publish(self, model, routing_key: str):
+        await self.send(model, routing_key)
+
+    async def close(self):
+        pass
+
+
+class LocalDelivery:
+    """Faz o papel da mensagem AMQP para o persister: o ack marca o item como concluído;
+    o nack(requeue) devolve o item à fila (sem bloquear quem está gravando) e o reject o
+    descarta"""
+
+    _requeues: ClassVar[set[asyncio.Task]] = set()  # referências fortes até a devolução terminar
+
+    def __init__(self, queue: asyncio.Queue, item):
+        self.queue = queue
+        self.item = item
+
+    @property
+    def body(self) -> bytes:
+        # O corpo que iria pelo broker (o persister conta as tentativas por ele)
+        return self.item.model_dump_json().encode()
+
+    async def ack(self):
+        self.queue.task_done()
+
+    async def nack(self, requeue: bool = True):
+        if requeue:
+            task = asyncio.create_task(self._requeue())
+            self._requeues.add(task)
+            task.add_done_callback(self._requeues.discard)
+        else:
+            self.queue.task_done()
+
+    async def reject(self, requeue: bool = False):
+        await self.nack(requeue)
+
+    async def _requeue(self):
+        # task_done só depois de devolver: o join() da fila não pode ver o item como concluído
+        await self.queue.put(self.item)
+        self.queue.task_done()
+
+
+def _ingest(path: Path) -> DownloadedFile:
+    """Arquivo local → blob store, com o mesmo resultado de um download (roda numa thread).
+    Copia para o staging calculando o sha256 na mesma passada; o original fica intacto"""
+    staging = get_staging_path()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as src, open(staging, "wb") as dst:
+        while chunk := src.read(COPY_CHUNK):
+            sha256.update(chunk)
+            dst.write(chunk)
+            size += len(chunk)
+    digest = sha256.hexdigest()
+    sniffed = sniff_file(staging)
+    storage_path, _ = get_blob_store().commit(staging, digest, path.name, text=sniffed.is_text)
+
+    original = TelegramDocument(
+        doc_id=0,
+        chat_id=0,
+        message_id=0,
+        filename=path.name,
+        mime_type=sniffed.mime,
+        size_bytes=size,
+    )
+    return DownloadedFile(
+        job_id=original.job_id,
+        doc_id=0,
+        sha256=digest,
+        storage_path=str(storage_path),
+        size_bytes=size,
+        mime_type=sniffed.mime,
+        extractable=sniffed.archive is not None,
+        original=original,
+    )
+
+
+class Pipeline:
+    """Os estágios num processo só, ligados por asyncio.Queue limitadas (PIPELINE_QUEUE_SIZE).
+
+    Origem: um diretório local (reprocessamento offline, testes, benchmark) ou o Telegram
+    (listener + downloader). Extractor e scanner são os mesmos dos serviços, com o
+    publisher trocado por `LocalPublisher`; o persister recebe `LocalDelivery` no lugar
+    das mensagens. Cada estágio tem tantos workers quanto o prefetch do serviço.
+    """
+
+    def __init__(self, source_dir: Path | None = None, persist: bool = True):
+        self.source_dir = source_dir
+        self.persist = persist
+        size = settings.pipeline_queue_size
+        self.pending: asyncio.Queue = asyncio.Queue(size)    # TelegramDocument
+        self.paths: asyncio.Queue = asyncio.Queue(size)      # arquivos locais
+        self.to_extract: asyncio.Queue = asyncio.Queue(size)
+        self.to_scan: asyncio.Queue = asyncio.Queue(size)
+        self.iocs: asyncio.Queue = asyncio.Queue(size)
+        self.publisher = LocalPublisher({
+            "documents.pending": [self.pending],
+            "documents.downloaded": [self.to_extract, self.to_scan],
+            "files.extracted": [self.to_scan],
+            "iocs.pending": [self.iocs],
+        })
+        self.extractor = SafeExtractor()
+        self.scanner = Scanner()
+        self.persister = None
+        self.listener = None
+        self.downloader = None
+        self.stats: dict[str, dict] = {}
+        self._workers: list[asyncio.Task] = []
+
+    def _spawn(self, name: str, queue: asyncio.Queue, handle, count: int):
+        stats = self.stats.setdefault(name, {"itens": 0, "erros": 0, "segundos": 0.0})
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                started = time.perf_counter()
+                try:
+                    await handle(item)
+                except Exception as e:
+                    stats["erros"] += 1
+                    log.exception("erro_estagio", estagio=name, error=str(e))
+                finally:
+                    stats["itens"] += 1
+                    stats["segundos"] += time.perf_counter() - started
+                    queue.task_done()
+
+        self._workers += [asyncio.create_task(worker()) for _ in range(max(1, count))]
+
+    async def _ingest(self, path: Path):
+        downloaded = await asyncio.to_thread(_ingest, path)
+        await self.publisher.publish(downloaded, "documents.downloaded")
+
+    async def _consume_iocs(self):
+        """O persister agrupa e dá ack por lote; sem persistência os IOCs só são contados"""
+        stats = self.stats.setdefault("persister", {"itens": 0, "iocs": 0})
+        while True:
+            item = await self.iocs.get()
+            hits = item.matches if isinstance(item, IOCBatch) else [item]
+            stats["itens"] += 1
+            stats["iocs"] += len(hits)
+            if self.persister:
+                await self.persister.add(LocalDelivery(self.iocs, item), item.file_sha256, hits)
+            else:
+                self.iocs.task_done()
+
+    async def start(self):
+        self.extractor.publisher = self.publisher
+        self.scanner.publisher = self.publisher
+        self.extractor.prepare()
+        self.scanner.prepare()
+        if self.persist:
+            from services.persister.main import Persister
+
+            self.persister = Persister()
+            self.persister.prepare()
+
+        self._spawn(
+            "extractor", self.to_extract, self.extractor.handle, settings.extractor_prefetch
+        )
+        self._spawn("scanner", self.to_scan, self.scanner.handle, self.scanner.prefetch)
+        self._workers.append(asyncio.create_task(self._consume_iocs()))
+
+        if self.source_dir:
+            self._spawn("origem", self.paths, self._ingest, settings.downloader_concurrency)
+            return
+
+        from services.downloader.main import Downloader
+
+        listener_module = importlib.import_module("services.telegra-listener.main")
+        self.downloader = Downloader()
+        self.downloader.publisher = self.publisher
+        await self.downloader.prepare()
+        self._spawn(
+            "downloader", self.pending, self.downloader.handle, settings.downloader_concurrency
+        )
+        self.listener = listener_module.TelegramListener()
+        self.listener.publisher = self.publisher
+        await self.listener.listen()
+
+    async def run_directory(self):
+        """Processa todos os arquivos do diretório e espera cada estágio esvaziar, em ordem"""
+        started = time.perf_counter()
+        files = 0
+        for path in sorted(self.source_dir.rglob("*")):
+            if path.is_file():
+                await self.paths.put(path)
+                files += 1
+        for queue in (self.paths, self.to_extract, self.to_scan, self.iocs):
+            await queue.join()
+        log.info(
+            "pipeline_concluido",
+            arquivos=files,
+            segundos=round(time.perf_counter() - started, 3),
+            estagios={
+                name: {k: round(v, 3) if isinstance(v, float) else v for k, v in s.items()}
+                for name, s in self.stats.items()
+            },
+        )
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        services = (self.listener, self.downloader, self.extractor, self.scanner, self.persister)
+        for service in services:
+            if service:
+                await service.stop()
+        log.info("pipeline_encerrado")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="fastleaksDF em um processo, sem RabbitMQ")
+    parser.add_argument("--dir", type=Path, help="processa os arquivos deste diretório e termina")
+    parser.add_argument(
+        "--no-persist", action="store_true", help="não grava no PostgreSQL (só conta os IOCs)"
+    )
+    args = parser.parse_args()
+
+    structlog.configure(
+        processors=[
+            structlog.processors.TimeStamper(fmt="iso"),
+            structlog.processors.add_log_level,
+            structlog.processors.JSONRenderer(),
+        ],
+        wrapper_class=structlog.make_filtering_bound_logger(20),
+    )
+
+    pipeline = Pipeline(args.dir, persist=not args.no_persist)
+    try:
+        await pipeline.start()
+        origem = str(args.dir) if args.dir else "telegram"
+        log.info("pipeline_ativo", origem=origem, persistir=pipeline.persist)
+        if args.dir:
+            await pipeline.run_directory()
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await pipeline.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
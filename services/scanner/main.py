@@ -1,94 +1,265 @@
 import asyncio
-import structlog
+import multiprocessing
+import os
+import queue
+from collections.abc import AsyncIterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from itertools import islice
 from pathlib import Path
-from aio_pika import connect_robust, ExchangeType, Message
+
+import structlog
+
+from shared.cache import ScanCache
 from shared.config import settings
-from shared.models import DownloadedFile, ExtractedFile, IOCMatch
+from shared.messaging import BatchPublisher, ConfirmWindow, connect, consume_lanes
+from shared.models import DownloadedFile, ExtractedFile, IOCBatch, IOCHit, IOCMatch
 from shared.patterns import ioc_matcher
+from shared.sniff import from_mime, sniff_file
+from shared.wire import decode, header
 
 log = structlog.get_logger(service="scanner")
 
+CHUNKS_IN_FLIGHT = 4  # trechos de IOCs entre o worker e o event loop, por arquivo
+POLL_S = 1.0          # sem trecho novo nesse intervalo, confere se o worker ainda está vivo
+
+
+def _scan_file(file_path: str, max_size_mb: int | None, encoding: str, chunk_size: int, out) -> int:
+    """Roda nos workers do pool (cada processo compila os padrões uma vez, no import).
+    Os matches saem pela fila `out` em trechos de `chunk_size`, à medida que são
+    encontrados; None marca o fim. Fila cheia → a varredura espera a publicação. Erro de
+    leitura ou descompressão falha o future do pool (o resultado parcial não é cacheado)"""
+    total = 0
+    try:
+        matches = ioc_matcher.iter_matches(file_path, max_size_mb=max_size_mb, encoding=encoding)
+        while chunk := list(islice(matches, chunk_size)):
+            out.put(chunk)
+            total += len(chunk)
+    finally:
+        out.put(None)
+    return total
+
 
 class Scanner:
     def __init__(self):
         self.connection = None
         self.channel = None
         self.exchange = None
+        self.publisher = None
+        workers = settings.scanner_workers
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        # Varreduras em voo limitadas pelo prefetch (lane small, 2 filas → até o dobro de workers):
+        # o pool segue ocupado enquanto os resultados anteriores são publicados e ackados
+        self.prefetch = max(2, self.workers)
+        self.pool = None
+        self.manager = None  # filas dos trechos de IOCs entre o pool e o event loop
+        self.cache = None
+        # Versão do resultado: conjunto de padrões + limite de tamanho vigente
+        self.scan_version = f"{ioc_matcher.fingerprint}:{settings.scanner_max_file_mb}"
 
     async def connect_rabbitmq(self):
-        self.connection = await connect_robust(settings.rabbitmq_url)
-        self.channel = await self.connection.channel()
-        await self.channel.set_qos(prefetch_count=2)
+        self.connection, self.channel, self.exchange = await connect()
+        self.publisher = BatchPublisher(self.exchange)
+
+    @staticmethod
+    def _skip(message) -> bool:
+        """Mime do header conclusivo e não-texto (archive, binário): descarta sem decodificar"""
+        sniffed = from_mime(header(message, "mime_type") or "")
+        return sniffed is not None and not sniffed.is_text
 
-        self.exchange = await self.channel.declare_exchange(
-            "fastleaksdf", ExchangeType.TOPIC, durable=True
+    async def _text_encoding(self, mime: str, file_path: str) -> str | None:
+        """Encoding para varrer o arquivo, ou None se não é texto. Vale a classificação por
+        conteúdo feita no downloader/extractor (mime com charset); mimes inconclusivos
+        (legados, do Telegram) → sniff dos primeiros KB do próprio arquivo"""
+        sniffed = from_mime(mime)
+        if sniffed is None:
+            if not Path(file_path).exists():
+                return None
+            sniffed = await asyncio.to_thread(sniff_file, file_path)
+        return sniffed.encoding if sniffed.is_text else None
+
+    async def _stream(self, file_path: str, encoding: str, size: int) -> AsyncIterator[list[dict]]:
+        """Trechos de até `size` matches, enquanto a varredura ainda anda"""
+        if self.pool is None:
+            matches = ioc_matcher.iter_matches(
+                file_path, max_size_mb=settings.scanner_max_file_mb, encoding=encoding
+            )
+            while chunk := list(islice(matches, size)):
+                yield chunk
+            return
+
+        out = self.manager.Queue(CHUNKS_IN_FLIGHT)
+        scan = asyncio.get_running_loop().run_in_executor(
+            self.pool, _scan_file, file_path, settings.scanner_max_file_mb, encoding, size, out
         )
 
-        q1 = await self.channel.declare_queue("documents.downloaded", durable=True)
-        q2 = await self.channel.declare_queue("files.extracted", durable=True)
-        await q1.bind(self.exchange, routing_key="documents.downloaded")
-        await q2.bind(self.exchange, routing_key="files.extracted")
-        await self.channel.declare_queue("iocs.pending", durable=True)
+        async def next_chunk():
+            while True:
+                try:
+                    return await asyncio.to_thread(out.get, True, POLL_S)
+                except queue.Empty:
+                    if scan.done():
+                        try:
+                            return out.get_nowait()
+                        except queue.Empty:
+                            scan.result()  # worker morto: propaga o erro do pool
+                            return None
 
-        return q1, q2
+        finished = False
+        try:
+            while (chunk := await next_chunk()) is not None:
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                # Publicação interrompida: esvazia a fila para o worker terminar e liberar o pool
+                while await next_chunk() is not None:
+                    pass
+            await scan
 
-    def _should_scan(self, mime: str, filename: str) -> bool:
-        text_ext = {".txt", ".csv", ".json", ".xml", ".log", ".ini", ".env", ".sql", ".conf", ".yml", ".yaml", ".md"}
-        bin_ext = {".jpg", ".jpeg", ".png", ".gif", ".mp4", ".mp3", ".exe", ".dll", ".so", ".pdf", ".doc", ".docx", ".xls", ".xlsx"}
-        ext = Path(filename).suffix.lower()
-        return ext in text_ext or (ext not in bin_ext and any(t in mime.lower() for t in ["text", "json", "xml", "csv"]))
+    async def _scan(self, file_path: str, sha256: str, encoding: str) -> AsyncIterator[list[dict]]:
+        """Matches do arquivo em trechos de até SCANNER_BATCH_MAX_MATCHES: do cache, ou da
+        varredura à medida que ela avança. Só resultados de até SCAN_CACHE_MAX_MATCHES são
+        acumulados para o cache"""
+        size = settings.scanner_batch_max_matches
+        if self.cache:
+            cached = await asyncio.to_thread(self.cache.get, sha256, self.scan_version)
+            if cached is not None:
+                log.debug("scan_cache_hit", sha256=sha256[:8], count=len(cached))
+                for start in range(0, len(cached), size):
+                    yield cached[start:start + size]
+                return
 
-    async def scan_and_publish(self, file_path: str, sha256: str, job_id: str):
         if not Path(file_path).exists():
             return
 
-        matches = ioc_matcher.scan_file(file_path, max_size_mb=10)
-        for m in matches:
-            ioc = IOCMatch(
-                job_id=job_id,
-                file_sha256=sha256,
-                file_path=file_path,
-                ioc_type=m["ioc_type"],
-                value=m["value"],
-                context=m["context"],
-                line_number=m["line_number"],
-            )
-            await self.exchange.publish(
-                Message(body=ioc.model_dump_json().encode(), delivery_mode=2),
-                routing_key="iocs.pending",
-            )
+        # Erro na varredura propaga daqui: só uma varredura completa chega ao cache
+        kept = [] if self.cache else None
+        async with aclosing(self._stream(file_path, encoding, size)) as chunks:
+            async for chunk in chunks:
+                if kept is not None:
+                    kept += chunk
+                    if len(kept) > settings.scan_cache_max_matches:
+                        kept = None
+                yield chunk
+        if kept is not None:
+            await asyncio.to_thread(self.cache.put, sha256, self.scan_version, kept)
 
-        if matches:
-            log.info("iocs_encontrados", sha256=sha256[:8], count=len(matches), tipos=list(set(m["ioc_type"] for m in matches)))
+    def _send_batch(
+        self, matches: list[dict], chunk: int, last: bool, file_path: str, sha256: str, job_id: str
+    ):
+        batch = IOCBatch(
+            job_id=job_id,
+            file_sha256=sha256,
+            file_path=file_path,
+            matches=[IOCHit(**m) for m in matches],
+            chunk=chunk,
+            last=last,
+        )
+        return self.publisher.send(batch, "iocs.pending")
+
+    def _send_match(self, m: dict, file_path: str, sha256: str, job_id: str):
+        ioc = IOCMatch(
+            job_id=job_id,
+            file_sha256=sha256,
+            file_path=file_path,
+            ioc_type=m["ioc_type"],
+            value=m["value"],
+            context=m["context"],
+            line_number=m["line_number"],
+        )
+        return self.publisher.send(ioc, "iocs.pending")
+
+    async def scan_and_publish(self, file_path: str, sha256: str, job_id: str, encoding: str):
+        # Cada trecho é publicado assim que sai da varredura, com no máximo
+        # PUBLISH_BATCH_SIZE confirmações pendentes; o ack espera todas
+        confirms = ConfirmWindow()
+        total, types = 0, set()
+        chunk, held = 0, None
+        async with aclosing(self._scan(file_path, sha256, encoding)) as chunks:
+            async for matches in chunks:
+                total += len(matches)
+                types.update(m["ioc_type"] for m in matches)
+                if not settings.scanner_publish_batches:
+                    for m in matches:
+                        await confirms.add(self._send_match(m, file_path, sha256, job_id))
+                    continue
+                # Um trecho fica retido até o próximo chegar: só então se sabe se era o último
+                if held is not None:
+                    sent = self._send_batch(held, chunk, False, file_path, sha256, job_id)
+                    await confirms.add(sent)
+                    chunk += 1
+                held = matches
+        if held is not None:
+            await confirms.add(self._send_batch(held, chunk, True, file_path, sha256, job_id))
+        await confirms.wait()
+
+        if total:
+            log.info("iocs_encontrados", sha256=sha256[:8], count=total, tipos=list(types))
+
+    async def handle(self, f: DownloadedFile | ExtractedFile):
+        encoding = await self._text_encoding(f.mime_type, f.storage_path)
+        if encoding:
+            await self.scan_and_publish(f.storage_path, f.sha256, str(f.job_id), encoding)
 
     async def process_downloaded(self, message):
         async with message.process():
             try:
-                d = DownloadedFile.model_validate_json(message.body)
-                if self._should_scan(d.mime_type, Path(d.storage_path).name):
-                    await self.scan_and_publish(d.storage_path, d.sha256, str(d.job_id))
+                if self._skip(message):
+                    return
+                await self.handle(decode(message, DownloadedFile))
             except Exception as e:
                 log.exception("erro_scan", error=str(e))
 
     async def process_extracted(self, message):
         async with message.process():
             try:
-                e = ExtractedFile.model_validate_json(message.body)
-                if self._should_scan(e.mime_type, e.filename):
-                    await self.scan_and_publish(e.storage_path, e.sha256, str(e.job_id))
+                if self._skip(message):
+                    return
+                await self.handle(decode(message, ExtractedFile))
             except Exception as e:
                 log.exception("erro_scan", error=str(e))
 
+    def prepare(self):
+        """Cache de resultados por sha256 e processos de varredura (com a fila dos blocos)"""
+        if settings.scan_cache_path:
+            self.cache = ScanCache(settings.scan_cache_path, settings.scan_cache_max_entries)
+        if self.workers:
+            context = multiprocessing.get_context("spawn")
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            self.manager = context.Manager()
+
     async def start(self):
-        q1, q2 = await self.connect_rabbitmq()
-        log.info("scanner_ativo", patterns=list(ioc_matcher.patterns.keys()))
-        await q1.consume(self.process_downloaded)
-        await q2.consume(self.process_extracted)
+        self.prepare()
+        await self.connect_rabbitmq()
+        log.info(
+            "scanner_ativo",
+            patterns=list(ioc_matcher.patterns.keys()),
+            prefiltros=len(ioc_matcher.finders),
+            workers=self.workers,
+            prefetch=self.prefetch,
+            prefetch_large=settings.scanner_large_prefetch,
+            scan_version=self.scan_version,
+        )
+        prefetch = {"small": self.prefetch, "large": settings.scanner_large_prefetch}
+        for name, callback in (
+            ("documents.downloaded", self.process_downloaded),
+            ("files.extracted", self.process_extracted),
+        ):
+            await consume_lanes(self.connection, name, callback, prefetch)
         await asyncio.Event().wait()
 
     async def stop(self):
+        if self.publisher:
+            await self.publisher.close()
         if self.connection:
             await self.connection.close()
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+        if self.manager:
+            self.manager.shutdown()
+        if self.cache:
+            self.cache.close()
         log.info("scanner_encerrado")
 
 
@@ -1,13 +1,19 @@
 import asyncio
+from datetime import UTC, datetime, timedelta
+
 import structlog
 from telethon import TelegramClient, events
-from telethon.tl.types import Document
-from aio_pika import connect_robust, Message, ExchangeType
+from telethon.tl.types import Document, InputMessagesFilterDocument
+
+from shared.cache import CheckpointStore
 from shared.config import settings
+from shared.messaging import LANES, BatchPublisher, connect, lane_key, lane_queue
 from shared.models import TelegramDocument
 
 log = structlog.get_logger(service="telegram-listener")
 
+BACKFILL_POLL_S = 5  # intervalo entre consultas à profundidade da fila
+
 
 class TelegramListener:
     def __init__(self):
@@ -20,54 +26,137 @@ class TelegramListener:
         self.connection = None
         self.channel = None
         self.exchange = None
+        self.publisher = None
+        self.checkpoints = None
+        self.caught_up: set[int] = set()  # canais com backfill concluído
+        self._backfill_slots = asyncio.Semaphore(settings.backfill_channels)
+        self._backfill_task = None
 
     async def connect_rabbitmq(self):
-        self.connection = await connect_robust(settings.rabbitmq_url)
-        self.channel = await self.connection.channel()
-        self.exchange = await self.channel.declare_exchange(
-            "fastleaksdf", ExchangeType.TOPIC, durable=True
-        )
-        queue = await self.channel.declare_queue(
-            "documents.pending",
-            durable=True,
-            arguments={
-                "x-dead-letter-exchange": "fastleaksdf-dlq",
-                "x-dead-letter-routing-key": "documents.failed",
-            },
-        )
-        await queue.bind(self.exchange, routing_key="documents.pending")
+        self.connection, self.channel, self.exchange = await connect()
+        self.publisher = BatchPublisher(self.exchange)
 
-    async def on_new_document(self, event):
-        if not event.message.document:
-            return
-
-        doc: Document = event.message.document
-        if not getattr(doc, "size", 0) or not getattr(doc, "mime_type", ""):
-            return
+    def _to_document(self, message, chat_id: int) -> TelegramDocument | None:
+        doc: Document = message.document
+        if not doc or not getattr(doc, "size", 0) or not getattr(doc, "mime_type", ""):
+            return None
 
         filename = (
             next((attr.file_name for attr in doc.attributes if hasattr(attr, "file_name")), None)
             or f"doc_{doc.id}"
         )
 
-        telegram_doc = TelegramDocument(
+        return TelegramDocument(
             doc_id=doc.id,
-            chat_id=event.chat_id,
-            message_id=event.message.id,
+            chat_id=chat_id,
+            message_id=message.id,
             filename=filename,
             mime_type=doc.mime_type,
             size_bytes=doc.size,
-            channel_url=f"https://t.me/c/{str(abs(event.chat_id))[4:]}/{event.message.id}" if event.chat_id else None,
+            timestamp=message.date or datetime.utcnow(),
+            channel_url=f"https://t.me/c/{str(abs(chat_id))[4:]}/{message.id}" if chat_id else None,
         )
 
-        await self.exchange.publish(
-            Message(body=telegram_doc.model_dump_json().encode(), delivery_mode=2),
-            routing_key="documents.pending",
+    def _publish(self, telegram_doc: TelegramDocument):
+        routing_key = lane_key("documents.pending", telegram_doc.size_bytes)
+        return self.publisher.send(telegram_doc, routing_key)
+
+    async def on_new_document(self, event):
+        telegram_doc = self._to_document(event.message, event.chat_id)
+        if not telegram_doc:
+            return
+
+        await self._publish(telegram_doc)
+        # Com o backfill do canal concluído, o checkpoint acompanha o tempo real
+        if self.checkpoints and event.chat_id in self.caught_up:
+            self.checkpoints.advance(event.chat_id, event.message.id)
+        log.info(
+            "documento_capturado",
+            doc_id=telegram_doc.doc_id,
+            filename=telegram_doc.filename,
+            size_mb=round(telegram_doc.size_bytes / 1024 / 1024, 2),
         )
-        log.info("documento_capturado", doc_id=doc.id, filename=filename, size_mb=round(doc.size / 1024 / 1024, 2))
 
-    async def start(self):
-        await self.connect_rabbitmq()
+    async def _wait_for_capacity(self):
+        """Throttle do backfill: espera documents.pending (as duas lanes) baixar do limite"""
+        while True:
+            pending = 0
+            for lane in LANES:
+                name = lane_queue("documents.pending", lane)
+                queue = await self.channel.declare_queue(name, passive=True)
+                pending += queue.declaration_result.message_count
+            if pending <= settings.backfill_max_pending:
+                return
+            log.info(
+                "backfill_aguardando_fila", pendentes=pending, limite=settings.backfill_max_pending
+            )
+            await asyncio.sleep(BACKFILL_POLL_S)
+
+    async def _flush_backfill(self, cid: int, batch: list[TelegramDocument], last_id: int):
+        """Publica o lote em pipeline; o checkpoint só avança após as confirmações
+        (at-least-once)"""
+        if self.channel:  # no pipeline embutido a fila local limitada faz o papel
+            await self._wait_for_capacity()
+        await asyncio.gather(*(self._publish(d) for d in batch))
+        if self.checkpoints:
+            self.checkpoints.advance(cid, last_id)
+
+    async def backfill_channel(self, cid: int):
+        """Histórico do canal, do checkpoint até a mensagem mais recente no início do
+        backfill (o que vier depois chega pelo handler de NewMessage)"""
+        async with self._backfill_slots:
+            since = self.checkpoints.get(cid) if self.checkpoints else 0
+            latest = await self.client.get_messages(cid, limit=1)
+            head = latest[0].id if latest else 0
+            if head <= since:
+                self.caught_up.add(cid)
+                return
+
+            kwargs = {}
+            if settings.backfill_max_age_days is not None:
+                max_age = timedelta(days=settings.backfill_max_age_days)
+                kwargs["offset_date"] = datetime.now(UTC) - max_age
+
+            log.info("backfill_iniciado", channel_id=cid, desde=since, ate=head)
+            batch, published, last_id = [], 0, since
+            # Do mais antigo para o mais novo: o checkpoint é sempre um prefixo processado
+            async for message in self.client.iter_messages(
+                cid,
+                reverse=True,
+                min_id=since,
+                max_id=head + 1,
+                filter=InputMessagesFilterDocument,
+                wait_time=settings.backfill_wait_s,
+                **kwargs,
+            ):
+                last_id = message.id
+                telegram_doc = self._to_document(message, cid)
+                if telegram_doc:
+                    batch.append(telegram_doc)
+                if len(batch) >= settings.backfill_batch_size:
+                    await self._flush_backfill(cid, batch, last_id)
+                    published += len(batch)
+                    batch = []
+
+            await self._flush_backfill(cid, batch, head)
+            published += len(batch)
+            self.caught_up.add(cid)
+            log.info("backfill_concluido", channel_id=cid, documentos=published, ate=head)
+
+    async def backfill(self):
+        results = await asyncio.gather(
+            *(self.backfill_channel(cid) for cid in settings.channel_ids_list),
+            return_exceptions=True,
+        )
+        for cid, result in zip(settings.channel_ids_list, results):
+            if isinstance(result, Exception):
+                log.error("backfill_falhou", channel_id=cid, error=str(result))
+
+    async def listen(self):
+        """Abre os checkpoints, conecta ao Telegram, registra os handlers dos canais e dispara o
+        backfill"""
+        if settings.listener_checkpoint_path:
+            self.checkpoints = CheckpointStore(settings.listener_checkpoint_path)
         await self.client.start()
         log.info("conectado_telegram", channels=settings.channel_ids_list)
 
@@ -78,14 +167,27 @@ class TelegramListener:
             )
             log.info("monitorando_canal", channel_id=cid)
 
-        log.info("listener_ativo")
+        if settings.listener_backfill:
+            self._backfill_task = asyncio.create_task(self.backfill())
+
+        log.info("listener_ativo", backfill=settings.listener_backfill)
+
+    async def start(self):
+        await self.connect_rabbitmq()
+        await self.listen()
         await asyncio.Event().wait()
 
     async def stop(self):
+        if self._backfill_task:
+            self._backfill_task.cancel()
         if self.client.is_connected():
             await self.client.disconnect()
+        if self.publisher:
+            await self.publisher.close()
         if self.connection:
             await self.connection.close()
+        if self.checkpoints:
+            self.checkpoints.close()
         log.info("listener_encerrado")
 
 
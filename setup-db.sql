@@ -9,4 +9,11 @@ CREATE DATABASE fastleaksdf OWNER fastleaks;
 -- Mas você pode pré-criar índices para performance:
 CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_documents_sha256 ON documents(sha256);
 CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_iocs_document_id ON iocs(document_id);
-CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_iocs_type_value ON iocs(ioc_type, value);
\ No newline at end of file
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_iocs_type_value ON iocs(ioc_type, value);
+
+-- Deduplicação de IOCs garantida pelo banco: o persister grava lotes com
+-- INSERT ... ON CONFLICT DO NOTHING sobre (document_id, ioc_type, value).
+-- Em bases existentes, remove duplicatas antes de criar o índice único.
+DELETE FROM iocs a USING iocs b
+ WHERE a.id > b.id AND a.document_id = b.document_id AND a.ioc_type = b.ioc_type AND a.value = b.value;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_iocs_document_type_value ON iocs(document_id, ioc_type, value);
@@ -0,0 +1,308 @@
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Hashable, Iterator
+from pathlib import Path
+from typing import Any
+
+EVICT_EVERY = 1000  # verifica o limite de entradas a cada N gravações
+
+MISSING = object()  # ausente no cache (≠ None, que é um negativo cacheado)
+
+
+class TTLCache:
+    """LRU em memória com TTL e cache negativo.
+
+    `None` é guardado como "não existe" com TTL curto, para que corridas (ex.: IOC
+    chegando antes do documento) não fiquem presas. Contadores de hit/miss medem
+    quanta carga o cache tira do banco. Thread-safe.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, negative_ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        ttl = self.negative_ttl if value is None else self.ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "entries": len(self._data),
+        }
+
+
+class ScanCache:
+    """Resultados de varredura por (sha256, versão do conjunto de padrões) em SQLite local.
+
+    Conteúdo repostado/recompactado chega com o mesmo sha256: o hit devolve os matches
+    gravados sem abrir o arquivo. Trocar qualquer IOC_PATTERNS_* muda a versão, e as
+    entradas antigas deixam de casar (e saem pela evicção LRU). Chamado em threads fora
+    do event loop, daí o lock.
+    """
+
+    def __init__(self, path: Path, max_entries: int):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS scan_results ("
+            " sha256 TEXT NOT NULL, version TEXT NOT NULL, matches BLOB NOT NULL,"
+            " used_at REAL NOT NULL, PRIMARY KEY (sha256, version))"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_scan_results_used_at ON scan_results (used_at)"
+        )
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, sha256: str, version: str) -> list[dict] | None:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT matches FROM scan_results WHERE sha256 = ? AND version = ?",
+                (sha256, version),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE scan_results SET used_at = ? WHERE sha256 = ? AND version = ?",
+                (time.time(), sha256, version),
+            )
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, sha256: str, version: str, matches: list[dict]):
+        blob = zlib.compress(json.dumps(matches).encode(), 1)
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO scan_results (sha256, version, matches, used_at)"
+                " VALUES (?, ?, ?, ?)",
+                (sha256, version, blob, time.time()),
+            )
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self.evict()
+
+    def evict(self):
+        """Remove as entradas menos usadas acima de `max_entries`"""
+        (count,) = self.db.execute("SELECT COUNT(*) FROM scan_results").fetchone()
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM scan_results WHERE rowid IN"
+                " (SELECT rowid FROM scan_results ORDER BY used_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def close(self):
+        self.db.close()
+
+
+class ManifestStore:
+    """Filhos diretos de cada archive já extraído, por sha256 do archive, em SQLite local.
+
+    O mesmo archive volta por vários canais: com o manifesto, o extractor reemite os
+    ExtractedFile sem descomprimir nada. Guarda só o nível seguinte (sha256, caminho no
+    storage, nome); archives aninhados têm o próprio manifesto, consultado a cada
+    profundidade. Usado pelas threads do extractor, daí o lock.
+    """
+
+    def __init__(self, path: Path, max_entries: int):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS archive_manifests ("
+            " sha256 TEXT PRIMARY KEY, members BLOB NOT NULL, used_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_archive_manifests_used_at ON archive_manifests (used_at)"
+        )
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, sha256: str) -> list[dict] | None:
+        """[{sha256, storage_path, filename}] na ordem do archive, ou None"""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT members FROM archive_manifests WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE archive_manifests SET used_at = ? WHERE sha256 = ?", (time.time(), sha256)
+            )
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, sha256: str, members: list[dict]):
+        blob = zlib.compress(json.dumps(members).encode(), 1)
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO archive_manifests (sha256, members, used_at)"
+                " VALUES (?, ?, ?)",
+                (sha256, blob, time.time()),
+            )
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self.evict()
+
+    def evict(self):
+        """Remove os manifestos menos usados acima de `max_entries`"""
+        (count,) = self.db.execute("SELECT COUNT(*) FROM archive_manifests").fetchone()
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM archive_manifests WHERE rowid IN"
+                " (SELECT rowid FROM archive_manifests ORDER BY used_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def close(self):
+        self.db.close()
+
+
+class BloomFilter:
+    """Filtro de Bloom em memória (bytearray + blake2b, double hashing)"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class SeenIndex:
+    """Documentos já baixados, por doc_id do Telegram e, opcionalmente, pela dica
+    (tamanho, nome) — que não confirma o conteúdo: dois arquivos diferentes podem coincidir.
+
+    Encaminhamentos mantêm o doc_id; o Bloom na frente do SQLite responde "nunca visto"
+    sem tocar no disco, e só os possíveis repetidos são confirmados no banco.
+    """
+
+    def __init__(self, path: Path, capacity: int):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS seen_documents ("
+            " key TEXT PRIMARY KEY, sha256 TEXT NOT NULL, storage_path TEXT NOT NULL,"
+            " seen_at REAL NOT NULL)"
+        )
+        (count,) = self.db.execute("SELECT COUNT(*) FROM seen_documents").fetchone()
+        self.bloom = BloomFilter(max(capacity, count * 2))
+        for (key,) in self.db.execute("SELECT key FROM seen_documents"):
+            self.bloom.add(key)
+
+    @staticmethod
+    def _keys(doc_id: int, size_bytes: int, filename: str, use_hints: bool) -> list[str]:
+        keys = [f"doc:{doc_id}"]
+        if use_hints:
+            keys.append(f"hint:{size_bytes}:{filename}")
+        return keys
+
+    def lookup(
+        self, doc_id: int, size_bytes: int, filename: str, use_hints: bool = False
+    ) -> tuple[str, str] | None:
+        """(sha256, storage_path) de um documento já baixado, ou None"""
+        for key in self._keys(doc_id, size_bytes, filename, use_hints):
+            if key not in self.bloom:
+                continue
+            row = self.db.execute(
+                "SELECT sha256, storage_path FROM seen_documents WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                return row
+        return None
+
+    def add(self, doc_id: int, size_bytes: int, filename: str, sha256: str, storage_path: str):
+        now = time.time()
+        for key in self._keys(doc_id, size_bytes, filename, use_hints=True):
+            self.db.execute(
+                "INSERT OR REPLACE INTO seen_documents (key, sha256, storage_path, seen_at)"
+                " VALUES (?, ?, ?, ?)",
+                (key, sha256, storage_path, now),
+            )
+            self.bloom.add(key)
+
+    def close(self):
+        self.db.close()
+
+
+class CheckpointStore:
+    """Último message_id processado por canal (backfill do listener), em SQLite local"""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS channel_checkpoints ("
+            " chat_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def get(self, chat_id: int) -> int:
+        row = self.db.execute(
+            "SELECT message_id FROM channel_checkpoints WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def advance(self, chat_id: int, message_id: int):
+        """Só avança (nunca volta para um id menor)"""
+        self.db.execute(
+            "INSERT INTO channel_checkpoints (chat_id, message_id, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (chat_id) DO UPDATE SET"
+            " message_id = MAX(message_id, excluded.message_id), updated_at = excluded.updated_at",
+            (chat_id, message_id, time.time()),
+        )
+
+    def close(self):
+        self.db.close()
@@ -1,5 +1,6 @@
 from pathlib import Path
-from typing import List
+
+from pydantic import field_validator, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -8,18 +9,33 @@ class Settings(BaseSettings):
 
     # RabbitMQ
     rabbitmq_url: str
+    publish_batch_size: int = 100          # mensagens por lote publicado em pipeline
+    publish_flush_ms: int = 20             # espera máxima para fechar um lote incompleto
+    publish_retries: int = 3               # novas tentativas de mensagens sem confirmação
+    publish_confirm_timeout_s: float = 30  # espera pela confirmação do broker
+    lane_large_mb: int = 64                # a partir daqui o arquivo segue pela lane large
+    wire_format: str = "json"              # "json" | "msgpack" (extra msgpack); leitura: ambos
 
     # Telegram
     telegram_api_id: int
     telegram_api_hash: str
     telegram_session_name: str
     telegram_channel_ids: str
+    telegram_download_sessions: str = ""  # sessões do pool do downloader, separadas por vírgula
 
     # PostgreSQL
     database_url: str
+    database_async: bool = True      # asyncpg via SQLAlchemy asyncio (False = engine síncrono)
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
 
     # Storage
     storage_path: Path = Path("./storage")
+    # Índices locais (*_path abaixo): sem valor definido, ficam em STORAGE_PATH/.cache
+    # sha256 → tamanho, codec, nomes
+    blob_index_path: Path = Path(".cache/blobs.sqlite")
+    storage_compression: str = ""        # blobs de texto: "" (cru), "zstd", "gzip" ou "auto"
+    storage_compression_min_kb: int = 64  # abaixo disso não compensa comprimir
 
     # IOC Patterns
     ioc_patterns_cpf: str
@@ -27,9 +43,98 @@ class Settings(BaseSettings):
     ioc_patterns_domain: str
     ioc_patterns_ip_internal: str
 
+    # Listener
+    listener_backfill: bool = True            # ao iniciar, percorre o histórico desde o checkpoint
+    listener_checkpoint_path: Path | None = Path(".cache/listener-checkpoints.sqlite")
+    backfill_channels: int = 4                # canais percorridos ao mesmo tempo
+    backfill_batch_size: int = 100            # documentos por lote publicado
+    backfill_max_pending: int = 5000          # pausa enquanto documents.pending tiver mais que isso
+    backfill_max_age_days: int | None = None  # None = histórico inteiro
+    backfill_wait_s: float = 1.0              # pausa entre páginas de 100 mensagens
+
+    # Downloader
+    downloader_concurrency: int = 8           # downloads simultâneos da lane small (= prefetch)
+    downloader_large_concurrency: int = 2     # downloads simultâneos da lane large
+    downloader_max_inflight_mb: int = 2048    # soma dos tamanhos em download ao mesmo tempo
+    downloader_rate_per_chat: float = 1.0     # requisições/s por chat
+    downloader_rate_global: float = 5.0       # requisições/s na conta (pausa em FLOOD_WAIT)
+    downloader_large_file_mb: int = 256       # daqui para cima, trechos paralelos (0 = nunca)
+    downloader_parts: int = 4                 # trechos simultâneos por arquivo grande
+    downloader_part_mb: int = 32              # tamanho de cada trecho
+    downloader_resolve_window_ms: int = 50    # janela p/ agrupar get_messages do mesmo chat
+    downloader_message_cache_s: int = 60      # vida das mensagens/referências resolvidas
+    # None = desativado
+    dedup_index_path: Path | None = Path(".cache/seen-documents.sqlite")
+    dedup_use_hints: bool = False             # (tamanho, nome) igual = repetido, sem ver o conteúdo
+    dedup_bloom_capacity: int = 1_000_000
+
+    # Extractor
+    extractor_workers: int = 4    # threads de descompressão
+    extractor_prefetch: int = 4   # archives em processamento ao mesmo tempo (lane small)
+    extractor_large_prefetch: int = 1  # archives da lane large ao mesmo tempo
+    # None = desativado
+    extract_manifest_path: Path | None = Path(".cache/archive-manifests.sqlite")
+    extract_manifest_max_entries: int = 200_000
+
+    # Scanner
+    scanner_max_file_mb: int | None = None  # limite de segurança opcional (None = sem limite)
+    scanner_workers: int | None = None      # processos (None = nº de CPUs, 0 = no event loop)
+    scanner_large_prefetch: int = 1         # arquivos da lane large em varredura, por fila
+    scanner_publish_batches: bool = True    # IOCBatch por arquivo (False = um IOCMatch por IOC)
+    scanner_batch_max_matches: int = 1000   # IOCs por mensagem IOCBatch
+    scan_cache_path: Path | None = Path(".cache/scan-results.sqlite")  # None = desativado
+    scan_cache_max_entries: int = 200_000
+    scan_cache_max_matches: int = 100_000   # resultados maiores são publicados, mas não cacheados
+
+    # Persister
+    persister_batch_size: int = 500  # IOCs por lote (1 = um commit por mensagem)
+    persister_batch_ms: int = 200    # espera máxima para fechar um lote incompleto
+    persister_cache_size: int = 100_000   # entradas dos caches sha256→documento e doc_id→fonte
+    persister_cache_ttl_s: int = 3600
+    persister_negative_ttl_s: int = 5     # "não encontrado" expira rápido (IOC antes do documento)
+    persister_max_attempts: int = 5       # gravações falhas por mensagem antes do iocs.failed
+
+    # Pipeline embutido (services/pipeline)
+    pipeline_queue_size: int = 1000  # itens por fila em memória entre estágios (backpressure)
+
+    @field_validator(
+        "backfill_max_age_days",
+        "scanner_max_file_mb",
+        "scanner_workers",
+        "listener_checkpoint_path",
+        "dedup_index_path",
+        "extract_manifest_path",
+        "scan_cache_path",
+        mode="before",
+    )
+    @classmethod
+    def _empty_is_none(cls, value):
+        # VAR= (vazia no .env ou no ambiente) vale como não definida: None. Nos caminhos,
+        # None desativa o índice local (sem isso viraria Path("."), um diretório)
+        return None if value == "" else value
+
+    @model_validator(mode="after")
+    def _under_storage(self):
+        # Índices não definidos acompanham STORAGE_PATH; definidos (ou vazios = None) valem
+        # como estão
+        for name in (
+            "blob_index_path",
+            "listener_checkpoint_path",
+            "dedup_index_path",
+            "extract_manifest_path",
+            "scan_cache_path",
+        ):
+            if name not in self.model_fields_set:
+                setattr(self, name, self.storage_path / getattr(self, name))
+        return self
+
     @property
-    def channel_ids_list(self) -> List[int]:
+    def channel_ids_list(self) -> list[int]:
         return [int(cid.strip()) for cid in self.telegram_channel_ids.split(",") if cid.strip()]
 
+    @property
+    def download_sessions_list(self) -> list[str]:
+        return [name.strip() for name in self.telegram_download_sessions.split(",") if name.strip()]
+
 
 settings = Settings()
\ No newline at end of file
@@ -0,0 +1,233 @@
+import asyncio
+from collections import deque
+from collections.abc import Awaitable, Callable
+
+import structlog
+from aio_pika import DeliveryMode, ExchangeType, Message, connect_robust
+from aio_pika.abc import AbstractChannel, AbstractExchange, AbstractRobustConnection
+from pydantic import BaseModel
+
+from shared.config import settings
+from shared.wire import encode
+
+log = structlog.get_logger(service="messaging")
+
+EXCHANGE = "fastleaksdf"
+DLX = "fastleaksdf-dlq"
+
+# Lanes por tamanho: arquivos grandes seguem em filas `.large` próprias, sem bloquear a
+# fila dos pequenos. A lane small é a fila original, que também recebe a routing key sem
+# sufixo (produtores anteriores às lanes)
+LANES = ("small", "large")
+
+# Fila → routing keys que ela recebe. Scanner e extractor consomem documents.downloaded
+# em filas próprias: cada um recebe todas as mensagens (numa fila só, dividiriam entre si)
+QUEUES: dict[str, list[str]] = {
+    "documents.pending": ["documents.pending", "documents.pending.small"],
+    "documents.pending.large": ["documents.pending.large"],
+    "documents.downloaded": ["documents.downloaded", "documents.downloaded.small"],  # scanner
+    "documents.downloaded.large": ["documents.downloaded.large"],
+    "documents.extract": ["documents.downloaded", "documents.downloaded.small"],     # extractor
+    "documents.extract.large": ["documents.downloaded.large"],
+    "files.extracted": ["files.extracted", "files.extracted.small"],
+    "files.extracted.large": ["files.extracted.large"],
+    "iocs.pending": ["iocs.pending"],
+}
+DEAD_LETTER_ARGUMENTS = {
+    "x-dead-letter-exchange": DLX,
+    "x-dead-letter-routing-key": "documents.failed",
+}
+QUEUE_ARGUMENTS = {
+    "documents.pending": DEAD_LETTER_ARGUMENTS,
+    "documents.pending.large": DEAD_LETTER_ARGUMENTS,
+}
+DEAD_LETTER_QUEUE = "documents.failed"
+IOC_DEAD_LETTER_QUEUE = "iocs.failed"  # IOCs que o persister desistiu de gravar (via DLX)
+
+
+def lane_of(size_bytes: int) -> str:
+    return "large" if size_bytes >= settings.lane_large_mb * 1024 * 1024 else "small"
+
+
+def lane_key(routing_key: str, size_bytes: int) -> str:
+    """documents.pending → documents.pending.small / documents.pending.large"""
+    return f"{routing_key}.{lane_of(size_bytes)}"
+
+
+def lane_queue(queue: str, lane: str) -> str:
+    return queue if lane == "small" else f"{queue}.{lane}"
+
+
+async def declare_topology(channel: AbstractChannel) -> AbstractExchange:
+    """Exchanges, filas e bindings do pipeline (idempotente). Todo serviço declara tudo
+    ao conectar: nenhuma mensagem é publicada antes de a fila de destino existir"""
+    exchange = await channel.declare_exchange(EXCHANGE, ExchangeType.TOPIC, durable=True)
+    dlx = await channel.declare_exchange(DLX, ExchangeType.TOPIC, durable=True)
+    for name in (DEAD_LETTER_QUEUE, IOC_DEAD_LETTER_QUEUE):
+        failed = await channel.declare_queue(name, durable=True)
+        await failed.bind(dlx, routing_key=name)
+
+    for name, routing_keys in QUEUES.items():
+        queue = await channel.declare_queue(name, durable=True, arguments=QUEUE_ARGUMENTS.get(name))
+        for routing_key in routing_keys:
+            await queue.bind(exchange, routing_key=routing_key)
+    return exchange
+
+
+async def connect(
+    prefetch: int | None = None,
+) -> tuple[AbstractRobustConnection, AbstractChannel, AbstractExchange]:
+    """Conexão robusta + canal com publisher confirms + topologia declarada"""
+    connection = await connect_robust(settings.rabbitmq_url)
+    channel = await open_channel(connection, prefetch)
+    exchange = await declare_topology(channel)
+    return connection, channel, exchange
+
+
+async def open_channel(
+    connection: AbstractRobustConnection, prefetch: int | None = None
+) -> AbstractChannel:
+    channel = await connection.channel(publisher_confirms=True)
+    if prefetch:
+        await channel.set_qos(prefetch_count=prefetch)
+    return channel
+
+
+async def consume_lanes(
+    connection: AbstractRobustConnection,
+    queue: str,
+    callback: Callable[..., Awaitable],
+    prefetch: dict[str, int],
+) -> list[AbstractChannel]:
+    """Um consumidor por lane de `queue`, cada um no próprio canal com o próprio prefetch:
+    o prefetch da lane large limita quantos arquivos grandes ficam em processamento, e a
+    lane small segue sendo consumida enquanto eles andam"""
+    channels = []
+    for lane in LANES:
+        channel = await open_channel(connection, prefetch[lane])
+        await (await channel.get_queue(lane_queue(queue, lane))).consume(callback)
+        channels.append(channel)
+    return channels
+
+
+class ConfirmWindow:
+    """Confirmações pendentes de um produtor, no máximo `size` de uma vez: ao encher, espera
+    a mais antiga. O produtor segue publicando em pipeline, mas não se adianta ao broker
+    (ou à fila do pipeline embutido) mais que a janela"""
+
+    def __init__(self, size: int | None = None):
+        self.size = size or settings.publish_batch_size
+        self._pending: deque[asyncio.Future] = deque()
+
+    async def add(self, confirm: Awaitable):
+        self._pending.append(asyncio.ensure_future(confirm))
+        if len(self._pending) >= self.size:
+            await self._pending.popleft()
+
+    async def wait(self):
+        """Espera todas as pendentes (a primeira falha é propagada)"""
+        pending, self._pending = self._pending, deque()
+        await asyncio.gather(*pending)
+
+
+class BatchPublisher:
+    """Publicação em lote sob publisher confirms.
+
+    `submit` enfileira uma mensagem persistente e devolve um future resolvido quando o
+    broker confirma. O lote sai quando junta `batch_size` mensagens ou `flush_ms` depois
+    da primeira; as mensagens do lote são publicadas em pipeline (sem esperar a
+    confirmação de uma para mandar a próxima). Mensagens recusadas ou sem confirmação
+    voltam a ser publicadas até `retries` vezes; depois o future falha.
+
+    Quem consome e publica espera os futures antes do ack da mensagem de entrada
+    (at-least-once).
+    """
+
+    def __init__(
+        self,
+        exchange: AbstractExchange,
+        batch_size: int | None = None,
+        flush_ms: int | None = None,
+        retries: int | None = None,
+        confirm_timeout_s: float | None = None,
+    ):
+        self.exchange = exchange
+        self.batch_size = batch_size or settings.publish_batch_size
+        self.flush_s = (flush_ms if flush_ms is not None else settings.publish_flush_ms) / 1000
+        self.retries = retries if retries is not None else settings.publish_retries
+        self.confirm_timeout_s = confirm_timeout_s or settings.publish_confirm_timeout_s
+        self._batch: list[tuple[Message, str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, body: bytes, routing_key: str, **properties) -> asyncio.Future:
+        message = Message(body=body, delivery_mode=DeliveryMode.PERSISTENT, **properties)
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((message, routing_key, future))
+        if len(self._batch) >= self.batch_size:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_s, self._dispatch)
+        return future
+
+    def send(self, model: BaseModel, routing_key: str) -> asyncio.Future:
+        """`submit` de um modelo de shared/models.py no formato de WIRE_FORMAT"""
+        body, properties = encode(model)
+        return self.submit(body, routing_key, **properties)
+
+    async def publish(self, model: BaseModel, routing_key: str):
+        """Um modelo, esperando a confirmação (entra no lote em formação)"""
+        await self.send(model, routing_key)
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list[tuple[Message, str, asyncio.Future]]):
+        for attempt in range(self.retries + 1):
+            results = await asyncio.gather(
+                *(
+                    self.exchange.publish(
+                        message, routing_key=routing_key, timeout=self.confirm_timeout_s
+                    )
+                    for message, routing_key, _ in batch
+                ),
+                return_exceptions=True,
+            )
+            failed = []
+            for entry, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    failed.append((entry, result))
+                elif not entry[2].done():
+                    entry[2].set_result(None)
+            if not failed:
+                return
+
+            if attempt < self.retries:
+                log.warning(
+                    "publicacao_sem_confirmacao",
+                    mensagens=len(failed),
+                    tentativa=attempt + 1,
+                    error=str(failed[0][1]),
+                )
+                await asyncio.sleep(min(2 ** attempt, 10))
+            batch = [entry for entry, _ in failed]
+
+        for (_, _, future), error in failed:
+            if not future.done():
+                future.set_exception(error)
+
+    async def flush(self):
+        """Publica o lote em formação e espera todas as confirmações pendentes"""
+        self._dispatch()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
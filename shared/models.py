@@ -1,9 +1,9 @@
 from datetime import datetime
-from typing import Optional
-from uuid import uuid4, UUID
-from pydantic import BaseModel, Field, field_validator, computed_field
-from sqlmodel import SQLModel, Field as SQLField
+from uuid import UUID, uuid4
 
+from pydantic import BaseModel, Field, field_validator
+from sqlmodel import Field as SQLField
+from sqlmodel import SQLModel, UniqueConstraint
 
 # ========== MENSAGENS RABBITMQ ==========
 
@@ -17,7 +17,7 @@ class TelegramDocument(BaseModel):
     mime_type: str
     size_bytes: int
     timestamp: datetime = Field(default_factory=datetime.utcnow)
-    channel_url: Optional[str] = None
+    channel_url: str | None = None
 
     @field_validator("filename")
     @classmethod
@@ -47,6 +47,7 @@ class ExtractedFile(BaseModel):
     filename: str
     mime_type: str
     depth: int = 0
+    size_bytes: int = 0  # 0 em mensagens de extractors anteriores às lanes
 
 
 class IOCMatch(BaseModel):
@@ -60,6 +61,24 @@ class IOCMatch(BaseModel):
     line_number: int
 
 
+class IOCHit(BaseModel):
+    """IOC dentro de um IOCBatch (campos do arquivo ficam no lote)"""
+    ioc_type: str
+    value: str
+    context: str
+    line_number: int
+
+
+class IOCBatch(BaseModel):
+    """IOCs de um arquivo, em trechos limitados → fila iocs.pending (type=IOCBatch)"""
+    job_id: UUID
+    file_sha256: str
+    file_path: str
+    matches: list[IOCHit]
+    chunk: int = 0
+    last: bool = True
+
+
 # ========== MODELOS POSTGRESQL ==========
 
 class TelegramSource(SQLModel, table=True):
@@ -91,6 +110,9 @@ class Document(SQLModel, table=True):
 
 class IOC(SQLModel, table=True):
     __tablename__ = "iocs"
+    __table_args__ = (
+        UniqueConstraint("document_id", "ioc_type", "value", name="uq_iocs_document_type_value"),
+    )
     
     id: int | None = SQLField(default=None, primary_key=True)
     document_id: int = SQLField(foreign_key="documents.id", index=True)
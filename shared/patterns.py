@@ -1,49 +1,322 @@
+import hashlib
+import json
 import re
+from collections.abc import Iterator
 from pathlib import Path
-from typing import List, Dict
+from re import _constants as _sre
+from re import _parser as _sre_parse
+
 from shared.config import settings
+from shared.storage import open_blob
+
+SCAN_FORMAT_VERSION = 1            # mude ao alterar o formato dos matches (invalida caches)
+CHUNK_CHARS = 1024 * 1024          # leitura em blocos fixos (memória constante)
+SEGMENT_OVERLAP = 4096             # sobreposição ao fatiar linhas gigantes
+CONTEXT_LINES = 2                  # ±2 linhas de contexto
+MAX_CONTEXT_LINE_CHARS = 1024      # linhas de contexto são truncadas
+
+# Pré-filtro: peso de cada item de uma âncora (literal vale mais que \d)
+LITERAL_WEIGHT = 2
+DIGIT_WEIGHT = 1
+MIN_ANCHOR_WEIGHT = 3              # abaixo disso a âncora casa em quase toda linha
+
+_REPEATS = (_sre.MAX_REPEAT, _sre.MIN_REPEAT, _sre.POSSESSIVE_REPEAT)
+
+
+def _clip(line: str) -> str:
+    return line.rstrip()[:MAX_CONTEXT_LINE_CHARS]
+
+
+def _window(line: str, start: int, end: int) -> str:
+    """Recorte da linha em torno do match (linhas longas não vão inteiras p/ o contexto)"""
+    if len(line) <= MAX_CONTEXT_LINE_CHARS:
+        return line.rstrip()
+    half = max(0, (MAX_CONTEXT_LINE_CHARS - (end - start)) // 2)
+    lo = max(0, start - half)
+    return line[lo:lo + MAX_CONTEXT_LINE_CHARS].rstrip()
+
+
+def _atom(op, av) -> tuple[str | None, int] | None:
+    """Item de largura 1 aproveitável na âncora: (caractere | None p/ \\d, peso)"""
+    if op is _sre.LITERAL:
+        return chr(av), LITERAL_WEIGHT
+    if op is _sre.IN and av == [(_sre.CATEGORY, _sre.CATEGORY_DIGIT)]:
+        return None, DIGIT_WEIGHT
+    return None
+
+
+def _best_anchor(items) -> tuple[int, list[tuple]] | None:
+    """Trecho obrigatório mais seletivo da regex: (peso, alternativas).
+
+    Todo match contém ao menos uma das alternativas, então linhas sem nenhuma
+    delas podem ser descartadas sem rodar o padrão completo.
+    """
+    best = None
+    run: list[str | None] = []
+    weight = 0
+
+    def consider(candidate):
+        nonlocal best
+        if candidate and (best is None or candidate[0] > best[0]):
+            best = candidate
+
+    def close():
+        nonlocal run, weight
+        if run:
+            consider((weight, [tuple(run)]))
+        run, weight = [], 0
+
+    for op, av in items:
+        if op is _sre.AT:
+            continue  # \b, ^, $: largura zero, não quebram a sequência
+        atom = _atom(op, av)
+        if atom:
+            run.append(atom[0])
+            weight += atom[1]
+            continue
+        if op in _REPEATS:
+            lo, hi, sub = av
+            atom = _atom(*sub[0]) if len(sub) == 1 else None
+            if lo >= 1 and atom:
+                # 1ª repetição encosta no que vem antes, a última no que vem depois
+                run.append(atom[0])
+                weight += atom[1]
+                if lo == hi == 1:
+                    continue
+                close()
+                run, weight = [atom[0]], atom[1]
+                continue
+            close()
+            if lo >= 1:
+                consider(_best_anchor(sub.data))
+            continue
+        close()
+        if op is _sre.SUBPATTERN:
+            _, add_flags, del_flags, sub = av
+            if not add_flags and not del_flags:
+                consider(_best_anchor(sub.data))
+        elif op is _sre.BRANCH:
+            alternatives = [_best_anchor(branch.data) for branch in av[1]]
+            if all(alternatives):
+                consider((
+                    min(a[0] for a in alternatives),
+                    [atoms for a in alternatives for atoms in a[1]],
+                ))
+    close()
+    return best
+
+
+def _anchors_of(pattern: re.Pattern) -> list[tuple] | None:
+    try:
+        best = _best_anchor(_sre_parse.parse(pattern.pattern, pattern.flags).data)
+    except Exception:
+        return None
+    if best is None or best[0] < MIN_ANCHOR_WEIGHT:
+        return None
+    return best[1]
+
+
+def _anchor_regex(atoms: tuple, fold: bool) -> str:
+    """Regex da âncora começando pelo 1º literal, para o `re` usar a busca rápida por
+    prefixo literal (alternações e classes no início desligam essa otimização)"""
+    def esc(a):
+        return r"\d" if a is None else re.escape(a.lower() if fold else a)
+
+    lead = next((i for i, a in enumerate(atoms) if a is not None), 0)
+    behind = f"(?<={''.join(map(esc, atoms[:lead + 1]))})" if lead else ""
+    return esc(atoms[lead]) + behind + "".join(map(esc, atoms[lead + 1:]))
 
 
 class IOCMatcher:
     def __init__(self):
-        self.patterns: Dict[str, re.Pattern] = {
+        self.patterns: dict[str, re.Pattern] = {
             "cpf": re.compile(settings.ioc_patterns_cpf),
             "email_gdf": re.compile(settings.ioc_patterns_email),
             "domain_df": re.compile(settings.ioc_patterns_domain),
             "ip_internal": re.compile(settings.ioc_patterns_ip_internal),
-            "credentials": re.compile(r"(?i)(password|senha|passwd)[\s:=\"']{0,3}([A-Za-z0-9@#$%^&*()_+\-={}\[\]:;\"'<>,.?/\\|`~]{8,})"),
+            "credentials": re.compile(
+                r"(?i)(password|senha|passwd)[\s:=\"']{0,3}"
+                r"([A-Za-z0-9@#$%^&*()_+\-={}\[\]:;\"'<>,.?/\\|`~]{8,})"
+            ),
         }
+        self.finders = self._build_finders()
+        self.fingerprint = hashlib.sha256(json.dumps([
+            SCAN_FORMAT_VERSION,
+            [(name, p.pattern, p.flags) for name, p in self.patterns.items()],
+        ]).encode()).hexdigest()[:16]
 
-    def scan_file(self, file_path: str, max_size_mb: int = 10) -> List[Dict]:
-        matches = []
+    def _build_finders(self) -> list[tuple[re.Pattern, bool]]:
+        """Pré-filtro: âncoras literais extraídas dos padrões (`@`, `df.gov.br`, `10.`,
+        `senha`...), cada uma uma varredura C barata sobre o bloco inteiro. Âncoras de
+        padrões case-insensitive rodam sobre o bloco em minúsculas. Padrões sem âncora
+        confiável servem de pré-filtro para si mesmos.
+
+        Retorna [(regex, usa_minusculas)].
+        """
+        anchors: dict[tuple[tuple, bool], None] = {}
+        finders = []
+        for pattern in self.patterns.values():
+            alternatives = _anchors_of(pattern)
+            if alternatives is None:
+                finders.append((re.compile(pattern.pattern, pattern.flags | re.MULTILINE), False))
+                continue
+            fold = bool(pattern.flags & re.IGNORECASE)
+            for atoms in alternatives:
+                anchors[(atoms, fold)] = None
+
+        def literal(atoms, fold):
+            text = "".join(a or "\0" for a in atoms)
+            return text.lower() if fold else text
+
+        # Âncora que contém outra âncora literal é redundante (gdfnet.df.gov.br ⊃ df.gov.br)
+        for atoms, fold in anchors:
+            redundant = any(
+                other != (atoms, fold) and other[1] == fold and None not in other[0]
+                and literal(*other) in literal(atoms, fold)
+                for other in anchors
+            )
+            if not redundant:
+                finders.append((re.compile(_anchor_regex(atoms, fold)), fold))
+        return finders
+
+    def _candidate_lines(self, block: str) -> list[int]:
+        """Índices das linhas do bloco em que algum pré-filtro casa"""
+        hits = set()
+        folded = None
+        for finder, fold in self.finders:
+            if fold and folded is None:
+                folded = block.lower()
+            text = folded if fold else block
+            pos = idx = 0
+            while match := finder.search(text, pos):
+                idx += text.count("\n", pos, match.start())
+                hits.add(idx)
+                end = text.find("\n", match.start())
+                if end < 0:
+                    break
+                pos, idx = end + 1, idx + 1
+        return sorted(hits)
+
+    def scan_file(
+        self, file_path: str, max_size_mb: int | None = None, encoding: str = "utf-8"
+    ) -> list[dict]:
+        return list(self.iter_matches(file_path, max_size_mb=max_size_mb, encoding=encoding))
+
+    def iter_matches(
+        self, file_path: str, max_size_mb: int | None = None, encoding: str = "utf-8"
+    ) -> Iterator[dict]:
+        """Varredura em streaming: memória constante independente do tamanho do arquivo.
+
+        `max_size_mb` é um limite de segurança opcional (None = sem limite), aplicado ao
+        tamanho em disco. Blobs comprimidos são lidos já descomprimidos, em streaming;
+        `encoding` vem do sniff do conteúdo (utf-8, utf-16, cp1252...).
+        """
         path = Path(file_path)
-        
-        if not path.exists() or path.stat().st_size > max_size_mb * 1024 * 1024:
-            return matches
+        if not path.exists():
+            return
+        if max_size_mb is not None and path.stat().st_size > max_size_mb * 1024 * 1024:
+            return
 
         try:
-            with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                lines = f.readlines()
-
-            for line_num, line in enumerate(lines, 1):
-                for ioc_type, pattern in self.patterns.items():
-                    for match in pattern.finditer(line):
-                        start = max(0, line_num - 3)
-                        end = min(len(lines), line_num + 2)
-                        context = "\n".join(
-                            f"{'>' if i+1 == line_num else ' '} {i+1:4d} | {lines[i].rstrip()}"
-                            for i in range(start, end)
-                        )
-                        matches.append({
-                            "ioc_type": ioc_type,
-                            "value": match.group(0),
-                            "line_number": line_num,
-                            "context": context,
-                        })
-        except Exception:
-            pass  # Arquivo binário ou encoding problemático → skip silencioso
-        
-        return matches
-
-
-ioc_matcher = IOCMatcher()
\ No newline at end of file
+            f = open_blob(path, "rt", encoding=encoding, errors="ignore")
+        except LookupError:
+            return  # encoding desconhecido → skip silencioso
+        # Erros de leitura/descompressão propagam: um resultado parcial não é resultado
+        with f:
+            yield from self._scan_stream(f)
+
+    def _match_line(
+        self, line: str, line_num: int, skip: int = 0, limit: int | None = None
+    ) -> Iterator[dict]:
+        """Matches de uma linha que começam em [skip, limit) — fatias de linhas gigantes"""
+        for ioc_type, pattern in self.patterns.items():
+            for match in pattern.finditer(line):
+                if match.start() < skip:
+                    continue
+                if limit is not None and match.start() >= limit:
+                    break
+                yield {
+                    "ioc_type": ioc_type,
+                    "value": match.group(0),
+                    "line_number": line_num,
+                    "hit": _window(line, match.start(), match.end()),
+                }
+
+    def _render(self, m: dict, line_at) -> dict:
+        line_num = m["line_number"]
+        context = []
+        for n in range(line_num - CONTEXT_LINES, line_num + CONTEXT_LINES + 1):
+            text = m["hit"] if n == line_num else line_at(n)
+            if text is not None:
+                context.append(f"{'>' if n == line_num else ' '} {n:4d} | {text}")
+        return {
+            "ioc_type": m["ioc_type"],
+            "value": m["value"],
+            "line_number": line_num,
+            "context": "\n".join(context),
+        }
+
+    def _scan_stream(self, f) -> Iterator[dict]:
+        first = 1               # número da primeira linha do bloco atual
+        carry = ""              # linha incompleta no fim do último bloco lido
+        skip = 0                # prefixo de `carry` já varrido (sobreposição de fatias)
+        tail: dict[int, str] = {}  # últimas linhas já processadas (contexto de matches pendentes)
+        pending: list[dict] = []   # matches aguardando as linhas seguintes para o contexto
+
+        while True:
+            chunk = f.read(CHUNK_CHARS)
+            buf = carry + chunk
+            if chunk:
+                cut = buf.rfind("\n")
+                if cut < 0:
+                    # Linha sem quebra maior que um bloco → varre uma fatia e mantém a
+                    # sobreposição, para não perder matches que cruzam a fronteira. Os
+                    # matches saem já, com o contexto que existe (recorte da própria linha
+                    # e linhas anteriores): esperar o fim da linha acumularia todos
+                    if len(buf) > CHUNK_CHARS:
+                        limit = len(buf) - SEGMENT_OVERLAP
+                        for m in self._match_line(buf, first, skip, limit):
+                            yield self._render(m, tail.get)
+                        back = min(SEGMENT_OVERLAP, limit)
+                        carry, skip = buf[limit - back:], back
+                    else:
+                        carry = buf
+                    continue
+                block, carry = buf[:cut], buf[cut + 1:]
+            elif buf:
+                block, carry = buf, ""
+            else:
+                break
+            first_skip, skip = skip, 0
+
+            lines = block.split("\n")
+            last = first + len(lines) - 1
+
+            def line_at(n: int, lines=lines, first=first) -> str | None:
+                if first <= n <= first + len(lines) - 1:
+                    return _clip(lines[n - first])
+                return tail.get(n)
+
+            for idx in self._candidate_lines(block):
+                line_skip = first_skip if idx == 0 else 0
+                pending.extend(self._match_line(lines[idx], first + idx, line_skip))
+
+            ready = [m for m in pending if m["line_number"] + CONTEXT_LINES <= last]
+            pending = [m for m in pending if m["line_number"] + CONTEXT_LINES > last]
+            for m in ready:
+                yield self._render(m, line_at)
+
+            for n in range(max(first, last - 2 * CONTEXT_LINES + 1), last + 1):
+                tail[n] = line_at(n)
+            for n in [n for n in tail if n <= last - 2 * CONTEXT_LINES]:
+                del tail[n]
+            first = last + 1
+
+            if not chunk:
+                break
+
+        for m in pending:
+            yield self._render(m, tail.get)
+
+
+ioc_matcher = IOCMatcher()
@@ -0,0 +1,147 @@
+import bz2
+import lzma
+import zlib
+from pathlib import Path
+from typing import NamedTuple
+
+from shared.storage import open_blob
+
+SNIFF_BYTES = 8192           # só o começo do arquivo é lido
+MAX_CONTROL_RATIO = 0.02     # acima disso (fora \t \n \r \f ESC) não é texto
+
+# Assinaturas no início do arquivo → formato de archive (mesmos nomes de ARCHIVE_SUFFIXES)
+ARCHIVE_MAGIC = [
+    (b"PK\x03\x04", "zip"),
+    (b"PK\x05\x06", "zip"),
+    (b"Rar!\x1a\x07", "rar"),
+    (b"7z\xbc\xaf\x27\x1c", "7z"),
+    (b"\x1f\x8b", "gz"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+]
+ARCHIVE_MIMES = {
+    "zip": "application/zip",
+    "rar": "application/vnd.rar",
+    "7z": "application/x-7z-compressed",
+    "tar": "application/x-tar",
+    "gz": "application/gzip",
+    "bz2": "application/x-bzip2",
+    "xz": "application/x-xz",
+}
+BINARY_MAGIC = [
+    (b"%PDF", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+    (b"\x7fELF", "application/x-elf"),
+    (b"MZ", "application/x-msdownload"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage"),
+    (b"SQLite format 3\x00", "application/vnd.sqlite3"),
+]
+BOMS = [
+    (b"\xef\xbb\xbf", "utf-8-sig"),
+    (b"\xff\xfe", "utf-16-le"),
+    (b"\xfe\xff", "utf-16-be"),
+]
+TAR_MAGIC_OFFSET = 257
+
+
+class Sniffed(NamedTuple):
+    kind: str                      # "text" | "archive" | "binary"
+    mime: str
+    encoding: str | None = None  # texto
+    archive: str | None = None   # formato para o extractor
+
+    @property
+    def is_text(self) -> bool:
+        return self.kind == "text"
+
+
+def _is_tar(data: bytes) -> bool:
+    return data[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + 5] == b"ustar"
+
+
+def _compressed_tar(archive: str, head: bytes) -> bool:
+    """tar.gz/tar.xz: descomprime só o cabeçalho do 1º membro (bz2 precisa do bloco
+    inteiro, então .tar.bz2 só é reconhecido pelo nome)"""
+    try:
+        if archive == "gz":
+            data = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(head, 512)
+        elif archive == "xz":
+            data = lzma.LZMADecompressor().decompress(head, max_length=512)
+        else:
+            data = bz2.BZ2Decompressor().decompress(head, max_length=512)
+    except Exception:
+        return False
+    return _is_tar(data)
+
+
+def _text_encoding(head: bytes) -> str | None:
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+
+    if b"\x00" in head:
+        # UTF-16 sem BOM: um zero a cada dois bytes (texto ASCII)
+        half = len(head) // 2
+        even, odd = head[0::2].count(0), head[1::2].count(0)
+        if half and odd > 0.4 * half and even < 0.05 * half:
+            return "utf-16-le"
+        if half and even > 0.4 * half and odd < 0.05 * half:
+            return "utf-16-be"
+        return None
+
+    controls = sum(1 for b in head if b < 32 and b not in b"\t\n\r\f\x1b")
+    if controls > len(head) * MAX_CONTROL_RATIO:
+        return None
+    try:
+        head.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as e:
+        if e.reason == "unexpected end of data":
+            return "utf-8"  # caractere multibyte cortado no fim da amostra
+    return "cp1252"  # 8 bits sem controles: dumps legados em Latin-1/Windows-1252
+
+
+def sniff_bytes(head: bytes) -> Sniffed:
+    """Classifica pelo começo do conteúdo: archive (formato), binário conhecido/desconhecido
+    ou texto (com encoding)"""
+    for magic, archive in ARCHIVE_MAGIC:
+        if head.startswith(magic):
+            if archive in ("gz", "bz2", "xz") and _compressed_tar(archive, head):
+                archive = "tar"
+            return Sniffed("archive", ARCHIVE_MIMES[archive], archive=archive)
+    if _is_tar(head):
+        return Sniffed("archive", ARCHIVE_MIMES["tar"], archive="tar")
+
+    for magic, mime in BINARY_MAGIC:
+        if head.startswith(magic):
+            return Sniffed("binary", mime)
+    if head[4:8] == b"ftyp":
+        return Sniffed("binary", "video/mp4")
+
+    encoding = _text_encoding(head)
+    if encoding:
+        return Sniffed("text", f"text/plain; charset={encoding}", encoding=encoding)
+    return Sniffed("binary", "application/octet-stream")
+
+
+def sniff_file(path) -> Sniffed:
+    """Lê só SNIFF_BYTES (blobs comprimidos já descomprimidos)"""
+    with open_blob(Path(path), "rb") as f:
+        return sniff_bytes(f.read(SNIFF_BYTES))
+
+
+def from_mime(mime: str) -> Sniffed | None:
+    """Reconstrói a classificação a partir de um mime produzido por `sniff_bytes`;
+    None quando o mime não é conclusivo (octet-stream, mime do Telegram sem charset)"""
+    mime = mime.strip().lower()
+    if mime.startswith("text/") and "charset=" in mime:
+        encoding = mime.split("charset=", 1)[1].split(";")[0].strip()
+        return Sniffed("text", mime, encoding=encoding)
+    for archive, archive_mime in ARCHIVE_MIMES.items():
+        if mime == archive_mime:
+            return Sniffed("archive", mime, archive=archive)
+    if any(mime == binary_mime for _, binary_mime in BINARY_MAGIC) or mime == "video/mp4":
+        return Sniffed("binary", mime)
+    return None
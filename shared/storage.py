@@ -0,0 +1,192 @@
+import functools
+import gzip
+import io
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from shared.config import settings
+
+try:
+    import zstandard  # opcional: codec preferido para blobs de texto
+except ImportError:
+    zstandard = None
+
+CODEC_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 5
+COPY_CHUNK = 1024 * 1024
+
+
+def _resolve_codec(name: str) -> str:
+    """"" = sem compressão; "auto" = zstd se instalado, senão gzip (stdlib)"""
+    if name == "auto":
+        return "zstd" if zstandard else "gzip"
+    if name == "zstd" and zstandard is None:
+        raise RuntimeError("STORAGE_COMPRESSION=zstd requer o pacote zstandard")
+    if name and name not in CODEC_SUFFIXES:
+        raise ValueError(f"STORAGE_COMPRESSION inválido: {name}")
+    return name
+
+
+def _codec_of(path: Path) -> str:
+    """Codec pelo nome do blob (<sha256>.zst / <sha256>.gz); outros arquivos são crus"""
+    if len(path.stem) != 64:
+        return ""
+    return next((codec for codec, suffix in CODEC_SUFFIXES.items() if path.suffix == suffix), "")
+
+
+def open_blob(path, mode: str = "rb", encoding: str = "utf-8", errors: str = "ignore"):
+    """Abre um arquivo do storage já descomprimido, em streaming ("rb" ou "rt")"""
+    path = Path(path)
+    codec = _codec_of(path)
+    if codec == "zstd":
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        stream = io.BufferedReader(raw, COPY_CHUNK)
+    elif codec == "gzip":
+        stream = gzip.open(path, "rb")
+    else:
+        stream = open(path, "rb")
+    if "t" in mode:
+        return io.TextIOWrapper(stream, encoding=encoding, errors=errors)
+    return stream
+
+
+def _compress(src: Path, dst: Path, codec: str):
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        if codec == "zstd":
+            with zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(fout, closefd=False) as w:
+                shutil.copyfileobj(fin, w, COPY_CHUNK)
+        else:
+            with gzip.GzipFile(fileobj=fout, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as w:
+                shutil.copyfileobj(fin, w, COPY_CHUNK)
+
+
+class BlobStore:
+    """Storage endereçado por conteúdo: `storage/blobs/ab/cd/<sha256>`.
+
+    O mesmo conteúdo com nomes diferentes ocupa um único blob; os nomes e o codec de
+    cada blob ficam num índice SQLite compartilhado entre os serviços (WAL), que
+    responde "já temos esse sha256?" sem varrer diretórios.
+
+    O commit é um `os.link` do staging para o caminho final: atômico e sem sobrescrever.
+    Quem perde a corrida (mesmo sha256 gravado por outro job/processo) só descarta o
+    próprio staging — o conteúdo é idêntico por definição.
+
+    Com `codec`, blobs de texto a partir de `min_compress_bytes` são gravados comprimidos
+    (`<sha256>.zst`/`.gz`); o sha256 continua sendo o do conteúdo original e a leitura
+    passa por `open_blob`.
+    """
+
+    def __init__(self, root: Path, index_path: Path, codec: str = "", min_compress_bytes: int = 0):
+        self.root = root / "blobs"
+        self.codec = _resolve_codec(codec)
+        self.min_compress_bytes = min_compress_bytes
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(
+            index_path, isolation_level=None, check_same_thread=False, timeout=30
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " sha256 TEXT PRIMARY KEY, size_bytes INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, codec TEXT NOT NULL DEFAULT '')"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(blobs)")}
+        if "codec" not in columns:
+            self.db.execute("ALTER TABLE blobs ADD COLUMN codec TEXT NOT NULL DEFAULT ''")
+        if "refs" in columns:  # índices antigos: contagem de referências sem uso
+            self.db.execute("ALTER TABLE blobs DROP COLUMN refs")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blob_names ("
+            " sha256 TEXT NOT NULL, filename TEXT NOT NULL, PRIMARY KEY (sha256, filename))"
+        )
+        self._lock = threading.Lock()  # extractor grava de várias threads
+
+    def path_for(self, sha256: str, codec: str = "") -> Path:
+        return self.root / sha256[:2] / sha256[2:4] / f"{sha256}{CODEC_SUFFIXES.get(codec, '')}"
+
+    def locate(self, sha256: str) -> Path | None:
+        """Caminho do blob pelo índice (chave primária + um stat), sem varrer diretórios"""
+        with self._lock:
+            row = self.db.execute("SELECT codec FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None:
+            return None
+        path = self.path_for(sha256, row[0])
+        return path if path.exists() else None
+
+    def exists(self, sha256: str) -> bool:
+        return self.locate(sha256) is not None
+
+    def filenames(self, sha256: str) -> list[str]:
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT filename FROM blob_names WHERE sha256 = ?", (sha256,)
+            ).fetchall()
+        return [name for (name,) in rows]
+
+    def commit(
+        self, staging: Path, sha256: str, filename: str, text: bool = False
+    ) -> tuple[Path, bool]:
+        """Move o staging para o blob `sha256` e registra o nome. `text` habilita a
+        compressão (bloqueante: chame fora do event loop).
+
+        Retorna (caminho do blob, criado); criado=False quando o blob já existia e o
+        staging foi descartado sem custo extra de disco.
+        """
+        size = staging.stat().st_size
+        existing = self.locate(sha256)
+        if existing:
+            staging.unlink(missing_ok=True)
+            self._record(sha256, size, filename, _codec_of(existing))
+            return existing, False
+
+        codec = self.codec if text and size >= self.min_compress_bytes else ""
+        source = staging
+        if codec:
+            source = staging.with_name(staging.name + CODEC_SUFFIXES[codec])
+            _compress(staging, source, codec)
+        target = self.path_for(sha256, codec)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(source, target)
+            created = True
+        except FileExistsError:
+            created = False
+        finally:
+            staging.unlink(missing_ok=True)
+            source.unlink(missing_ok=True)
+        self._record(sha256, size, filename, codec)
+        return target, created
+
+    def _record(self, sha256: str, size: int, filename: str, codec: str):
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO blobs (sha256, size_bytes, created_at, codec)"
+                " VALUES (?, ?, ?, ?)"
+                # Blob regravado (arquivo sumiu do disco) pode ter outro codec
+                " ON CONFLICT (sha256) DO UPDATE SET codec = excluded.codec",
+                (sha256, size, time.time(), codec),
+            )
+            self.db.execute(
+                "INSERT OR IGNORE INTO blob_names (sha256, filename) VALUES (?, ?)",
+                (sha256, filename),
+            )
+
+    def close(self):
+        self.db.close()
+
+
+@functools.cache
+def get_blob_store() -> BlobStore:
+    """Instância do processo (o índice é aberto no primeiro uso)"""
+    return BlobStore(
+        settings.storage_path,
+        settings.blob_index_path,
+        settings.storage_compression,
+        settings.storage_compression_min_kb * 1024,
+    )
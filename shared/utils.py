@@ -1,28 +1,25 @@
-import hashlib
-import os
 from pathlib import Path
+from uuid import uuid4
+
 from shared.config import settings
 
 
-def compute_sha256(file_path: Path) -> str:
-    """SHA256 com streaming (evita OOM)"""
-    sha256 = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            sha256.update(chunk)
-    return sha256.hexdigest()
+def get_staging_path() -> Path:
+    """Arquivo temporário no mesmo filesystem do storage: o commit é um link atômico"""
+    staging = settings.storage_path / ".staging"
+    staging.mkdir(parents=True, exist_ok=True)
+    return staging / f"{uuid4().hex}.part"
 
 
-def get_storage_path(sha256: str, filename: str) -> Path:
-    """Estrutura: storage/ab/cd/arquivo.zip"""
-    storage = settings.storage_path
-    prefix1, prefix2 = sha256[:2], sha256[2:4]
-    path = storage / prefix1 / prefix2
-    path.mkdir(parents=True, exist_ok=True)
-    safe_name = f"{sha256}_{filename}"
-    return path / safe_name
+# Extensão → formato de archive; as compostas vêm antes das simples (.tar.gz antes de .gz)
+ARCHIVE_SUFFIXES = {
+    ".tar.gz": "tar", ".tgz": "tar", ".tar.bz2": "tar", ".tbz2": "tar",
+    ".tar.xz": "tar", ".txz": "tar", ".tar": "tar",
+    ".zip": "zip", ".rar": "rar", ".7z": "7z",
+    ".gz": "gz", ".bz2": "bz2", ".xz": "xz",
+}
 
 
-def is_extractable(mime_type: str, filename: str) -> bool:
-    ext = os.path.splitext(filename)[1].lower()
-    return ext in (".zip", ".rar", ".7z") or any(t in mime_type.lower() for t in ["zip", "rar", "7z", "archive"])
\ No newline at end of file
+def archive_kind(filename: str) -> str | None:
+    name = filename.lower()
+    return next((kind for suffix, kind in ARCHIVE_SUFFIXES.items() if name.endswith(suffix)), None)
\ No newline at end of file
@@ -0,0 +1,64 @@
+from typing import Any, TypeVar
+
+from pydantic import BaseModel
+
+from shared.config import settings
+
+try:
+    import msgpack  # opcional: formato binário das mensagens
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+SCHEMA_VERSION = 1
+SCHEMA_HEADER = "x-schema-version"
+
+# Campos copiados para os headers: consumidores filtram/roteiam sem decodificar o corpo
+ROUTING_FIELDS = {
+    "TelegramDocument": ("size_bytes", "mime_type"),
+    "DownloadedFile": ("sha256", "size_bytes", "mime_type", "extractable"),
+    "ExtractedFile": ("sha256", "size_bytes", "mime_type", "depth"),
+    "IOCMatch": ("file_sha256", "ioc_type"),
+    "IOCBatch": ("file_sha256", "chunk", "last"),
+}
+
+M = TypeVar("M", bound=BaseModel)
+
+
+def _resolve_format(name: str) -> str:
+    if name == "msgpack" and msgpack is None:
+        raise RuntimeError("WIRE_FORMAT=msgpack requer o pacote msgpack")
+    if name not in ("json", "msgpack"):
+        raise ValueError(f"WIRE_FORMAT inválido: {name}")
+    return name
+
+
+def encode(model: BaseModel, wire_format: str | None = None) -> tuple[bytes, dict]:
+    """(corpo, propriedades AMQP) de um modelo de shared/models.py. O tipo e a versão do
+    schema vão nas propriedades; JSON continua sendo o padrão (e o que todo consumidor lê)"""
+    wire_format = _resolve_format(wire_format or settings.wire_format)
+    name = type(model).__name__
+    headers = {SCHEMA_HEADER: SCHEMA_VERSION}
+    for field in ROUTING_FIELDS.get(name, ()):
+        headers[field] = getattr(model, field)
+
+    if wire_format == "msgpack":
+        body, content_type = msgpack.packb(model.model_dump(mode="json")), MSGPACK
+    else:
+        body, content_type = model.model_dump_json().encode(), JSON
+    return body, {"content_type": content_type, "type": name, "headers": headers}
+
+
+def header(message, name: str, default: Any = None) -> Any:
+    """Campo de roteamento sem tocar no corpo (None em mensagens de produtores antigos)"""
+    return (message.headers or {}).get(name, default)
+
+
+def decode(message, model: type[M]) -> M:
+    """Decodifica pelo content-type; sem content-type é JSON (produtores antigos)"""
+    if message.content_type == MSGPACK:
+        if msgpack is None:
+            raise RuntimeError("mensagem msgpack recebida sem o pacote msgpack instalado")
+        return model.model_validate(msgpack.unpackb(message.body))
+    return model.model_validate_json(message.body)